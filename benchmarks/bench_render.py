@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+    Render benchmark of sphinxcontrib-actdiag
+
+    Builds synthetic document trees having 10, 100 and 1000 actdiag blocks
+    (of various lanes and nodes) with the HTML (PNG and SVG) and LaTeX (PNG
+    and PDF) builders.  Each build runs in a fresh interpreter and records
+    wall time, peak RSS and the time spent on parsing, layout, drawing and
+    saving diagrams.  Results are written as JSON; compare two of them to
+    see the difference between commits.
+
+    Usage:
+        python benchmarks/bench_render.py run [-o result.json] [--sizes 10,100]
+                                              [--fontpath /path/to/font.ttf]
+        python benchmarks/bench_render.py compare base.json result.json
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from io import StringIO
+
+SCENARIOS = {
+    'html-png': ('html', {'actdiag_html_image_format': 'PNG'}),
+    'html-svg': ('html', {'actdiag_html_image_format': 'SVG'}),
+    'latex-png': ('latex', {'actdiag_latex_image_format': 'PNG'}),
+    'latex-pdf': ('latex', {'actdiag_latex_image_format': 'PDF'}),
+}
+SIZES = (10, 100, 1000)
+DIAGRAMS_PER_DOCUMENT = 10
+PHASES = ('parse', 'layout', 'draw', 'save')
+
+
+def generate_diagram(rand, index):
+    lanes = rand.randint(1, 4)
+    names = []
+    lines = []
+    for i in range(lanes):
+        members = ['N%d_%d_%d' % (index, i, j) for j in range(rand.randint(1, 6))]
+        lines.append('  lane lane%d {\n    label = "Lane %d";\n    %s;\n  }' % (i, i, '; '.join(members)))
+        names.extend(members)
+
+    rand.shuffle(names)
+    edges = ' -> '.join(names)
+    return 'actdiag {\n  %s;\n\n%s\n}' % (edges, '\n'.join(lines))
+
+
+def generate_tree(srcdir, size, seed=0):
+    """Write a document tree having *size* diagrams to *srcdir*."""
+    rand = random.Random(seed)
+    with open(os.path.join(srcdir, 'conf.py'), 'w') as f:
+        f.write("extensions = ['sphinxcontrib.actdiag']\n"
+                "master_doc = 'index'\n"
+                "latex_documents = [('index', 'bench.tex', 'bench', 'bench', 'manual')]\n")
+
+    docnames = []
+    for start in range(0, size, DIAGRAMS_PER_DOCUMENT):
+        docname = 'doc%04d' % start
+        with open(os.path.join(srcdir, docname + '.rst'), 'w') as f:
+            f.write('%s\n%s\n\n' % (docname, '=' * len(docname)))
+            for index in range(start, min(start + DIAGRAMS_PER_DOCUMENT, size)):
+                code = generate_diagram(rand, index)
+                f.write('.. actdiag::\n\n%s\n\n' % ''.join('   ' + line + '\n' for line in code.splitlines()))
+        docnames.append(docname)
+
+    with open(os.path.join(srcdir, 'index.rst'), 'w') as f:
+        f.write('bench\n=====\n\n.. toctree::\n\n%s' % ''.join('   %s\n' % name for name in docnames))
+
+
+def install_timers(timings):
+    """Wrap the stages of the render pipeline to accumulate their time."""
+    import actdiag.builder
+    import actdiag.drawer
+    import actdiag.parser
+    import sphinxcontrib.actdiag
+
+    def timed(phase, func):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[phase] += time.perf_counter() - started
+        return wrapper
+
+    actdiag.parser.parse_string = timed('parse', actdiag.parser.parse_string)
+    builder = actdiag.builder.ScreenNodeBuilder
+    builder.build = classmethod(timed('layout', builder.build.__func__))
+    drawer = actdiag.drawer.DiagramDraw
+    drawer.draw = timed('draw', drawer.draw)
+    drawer.save = timed('save', drawer.save)
+    # SVG images are written by the extension, not by DiagramDraw.save()
+    sphinxcontrib.actdiag.write_svg = timed('save', sphinxcontrib.actdiag.write_svg)
+
+
+def run_build(scenario, size, workdir, fontpath=None):
+    """Build a synthetic tree in this process and returns its measurements."""
+    from sphinx.application import Sphinx
+
+    buildername, confoverrides = SCENARIOS[scenario]
+    confoverrides = dict(confoverrides, actdiag_fontpath=fontpath)
+    srcdir = os.path.join(workdir, 'src')
+    os.mkdir(srcdir)
+    generate_tree(srcdir, size)
+
+    timings = dict.fromkeys(PHASES, 0.0)
+    install_timers(timings)
+
+    warnings = StringIO()
+    started = time.perf_counter()
+    app = Sphinx(srcdir, srcdir, os.path.join(workdir, 'out'), os.path.join(workdir, 'doctrees'),
+                 buildername, confoverrides, status=None, warning=warnings, freshenv=True)
+    app.build(force_all=True)
+    wall = time.perf_counter() - started
+
+    return {'scenario': scenario,
+            'diagrams': size,
+            'wall': wall,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'phases': timings,
+            'warnings': len(warnings.getvalue().splitlines())}
+
+
+def spawn_build(scenario, size, fontpath=None):
+    workdir = tempfile.mkdtemp()
+    try:
+        command = [sys.executable, os.path.abspath(__file__), 'build', scenario, str(size), workdir]
+        if fontpath:
+            command.extend(['--fontpath', fontpath])
+        output = subprocess.check_output(command)
+        return json.loads(output.decode('utf-8'))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def get_revision():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL)
+        return output.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def command_run(options):
+    results = []
+    for size in options.sizes:
+        for scenario in options.scenarios:
+            result = spawn_build(scenario, size, options.fontpath)
+            sys.stderr.write('%-10s %5d diagrams: %8.2fs %8d KB %5d warnings\n' %
+                             (scenario, size, result['wall'], result['peak_rss_kb'], result['warnings']))
+            results.append(result)
+
+    report = {'benchmark': 'render',
+              'fontpath': options.fontpath,
+              'revision': get_revision(),
+              'python': sys.version.split()[0],
+              'results': results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+def command_build(options):
+    result = run_build(options.scenario, options.size, options.workdir, options.fontpath)
+    json.dump(result, sys.stdout)
+
+
+def command_compare(options):
+    def load(path):
+        with open(path) as f:
+            report = json.load(f)
+        return report, {(r['scenario'], r['diagrams']): r for r in report['results']}
+
+    base_report, base = load(options.base)
+    report, current = load(options.current)
+    print('%-10s %8s %10s %10s %8s %10s' %
+          ('scenario', 'diagrams', base_report.get('revision') or 'base',
+           report.get('revision') or 'current', 'ratio', 'rss ratio'))
+    for key in sorted(set(base) & set(current)):
+        old, new = base[key], current[key]
+        print('%-10s %8d %9.2fs %9.2fs %7.2fx %9.2fx' %
+              (key[0], key[1], old['wall'], new['wall'], new['wall'] / old['wall'],
+               float(new['peak_rss_kb']) / old['peak_rss_kb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run = subparsers.add_parser('run', help='run benchmarks')
+    run.add_argument('-o', '--output', help='write results to the file (default: stdout)')
+    run.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                     type=lambda value: [int(size) for size in value.split(',')])
+    run.add_argument('--scenarios', default=','.join(sorted(SCENARIOS)),
+                     type=lambda value: value.split(','))
+    run.add_argument('--fontpath', help='TrueType font for diagrams (required to output PDF)')
+    run.set_defaults(handler=command_run)
+
+    build = subparsers.add_parser('build', help=argparse.SUPPRESS)
+    build.add_argument('scenario', choices=sorted(SCENARIOS))
+    build.add_argument('size', type=int)
+    build.add_argument('workdir')
+    build.add_argument('--fontpath')
+    build.set_defaults(handler=command_build)
+
+    compare = subparsers.add_parser('compare', help='compare two results')
+    compare.add_argument('base')
+    compare.add_argument('current')
+    compare.set_defaults(handler=command_compare)
+
+    options = parser.parse_args(argv)
+    options.handler(options)
+
+
+if __name__ == '__main__':
+    main()
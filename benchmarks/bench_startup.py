@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    Startup benchmark of sphinxcontrib-actdiag
+
+    Measures the time to import ``sphinxcontrib.actdiag`` and to call its
+    ``setup()``; Sphinx pays it on every build, even if no diagrams are
+    rendered.  Each round runs in a fresh interpreter, after Sphinx itself
+    is imported.
+
+    Usage: python benchmarks/bench_startup.py [--rounds N]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+ROUND = r'''
+import json
+import sys
+import time
+
+import sphinx.application  # NOQA: exclude the startup of Sphinx itself
+
+
+class App(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+started = time.perf_counter()
+import sphinxcontrib.actdiag  # NOQA
+imported = time.perf_counter()
+sphinxcontrib.actdiag.setup(App())
+finished = time.perf_counter()
+
+heavy = ('actdiag.parser', 'actdiag.drawer', 'blockdiag.utils.bootstrap', 'funcparserlib')
+print(json.dumps({'import': imported - started,
+                  'setup': finished - imported,
+                  'loaded': sorted(name for name in heavy if name in sys.modules)}))
+'''
+
+
+def run_round():
+    output = subprocess.check_output([sys.executable, '-c', ROUND])
+    return json.loads(output.decode('utf-8'))
+
+
+def summarize(values):
+    return {'min': min(values) * 1000,
+            'median': statistics.median(values) * 1000,
+            'max': max(values) * 1000}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=10)
+    options = parser.parse_args(argv)
+
+    rounds = [run_round() for _ in range(options.rounds)]
+    result = {
+        'benchmark': 'startup',
+        'python': sys.version.split()[0],
+        'rounds': options.rounds,
+        'unit': 'ms',
+        'import': summarize([r['import'] for r in rounds]),
+        'setup': summarize([r['setup'] for r in rounds]),
+        'total': summarize([r['import'] + r['setup'] for r in rounds]),
+        'loaded': rounds[-1]['loaded'],
+    }
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,52 +12,208 @@
 
 from __future__ import absolute_import
 
+import io
 import os
 import re
+import json
+import time
+import pickle
 import posixpath
+import shutil
+import tempfile
+import socket
+import socketserver
+import sys
+import threading
 import traceback
-import pkg_resources
-from collections import namedtuple
+import cProfile
+import itertools
+import uuid
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial, wraps
+from hashlib import sha1
 from docutils import nodes
+from docutils.parsers import rst
 from sphinx import addnodes
 from sphinx.util import logging
 from sphinx.util.osutil import ensuredir
 
-import actdiag.utils.rst.nodes
-import actdiag.utils.rst.directives
-from blockdiag.utils.bootstrap import detectfont, Application
-from blockdiag.utils.fontmap import FontMap
-from blockdiag.utils.rst.directives import with_blockdiag
+# actdiag, blockdiag and PIL are imported on demand; they are not needed
+# to start Sphinx up, and not at all for projects having no diagrams.
+import actdiag
 
-# fontconfig; it will be initialized on `builder-inited` event.
-fontmap = None
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# guards the global state of blockdiag; the uuid generator, font caches,
+# drawers, the application context (see BlockdiagContext) and the invariant
+# mode of reportlab
+blockdiag_lock = threading.RLock()
+
+# a key of font caches; compatible with FontInfo for the drawers of blockdiag
+FontKey = namedtuple('FontKey', 'path size')
+
+# the functions of blockdiag replaced by the font caches; keyed by their owners and names
+font_cache_originals = {}
+
+# parsed and laid out diagrams; keyed by their code (and resolved hrefs) (see build_diagram())
+DIAGRAM_CACHE_SIZE = 1024
+diagram_cache = OrderedDict()
+
+# the number of inline SVG markups kept in the cache of application (see html_render_svg())
+SVG_CACHE_SIZE = 256
 
 logger = logging.getLogger(__name__)
 
+# filenames of images generated by this extension
+IMAGE_FILENAME = re.compile(r'^actdiag-([0-9a-f]{40})\b')
+
+# hrefs of diagrams; references to labels, and absolute (or fragment only) URIs
+REFERENCE = re.compile(r'^:ref:`(.+?)`', re.UNICODE)
+ABSOLUTE_URI = re.compile(r'^([a-z][a-z0-9+.-]*:|/|#)', re.I)
+
+# stages of rendering a diagram (see DiagramProfiler)
+PHASES = ('parse', 'layout', 'draw', 'save')
+
+# a diagram to be rendered by the render pool; it must be picklable.
+# The jobs are sent to the workers in batches of (up to) POOL_BATCH_SIZE.
+POOL_BATCH_SIZE = 32
+RenderJob = namedtuple('RenderJob', ('code options format filename antialias transparency fontpath fontmap '
+                                     'scales lockdir max_canvas_pixels'))
+
+# the number of diagrams drawn at the same time in the process; each of them
+# holds its canvas until saved (see render_on_demand() and render_image())
+MAX_LIVE_RENDERS = max(2, os.cpu_count() or 1)
+render_slots = threading.BoundedSemaphore(MAX_LIVE_RENDERS)
+
+# the number of lock files to render images (see render_lock())
+LOCK_BUCKETS = 64
+
+# page size, and hrefs and boxes of drawable nodes of a diagram (see actdiag_node.to_layout())
+DiagramLayout = namedtuple('DiagramLayout', 'pagesize cells')
+
+
+class actdiag_node(nodes.General, nodes.Element):
+    name = 'actdiag'
+
+    def to_diagram(self, builder=None, standalone=False):
+        """Returns the laid out diagram.
 
-class actdiag_node(actdiag.utils.rst.nodes.actdiag):
-    def to_drawer(self, image_format, builder, **kwargs):
+        If *builder* is given, the hrefs of nodes are resolved for it (see
+        ``resolve_reference()``).  The diagrams are shared between documents
+        and threads; they are never modified after built.
+        """
+        self['code'], diagram = build_diagram(self['code'], self.get('timings'))
+        if builder is None:
+            return diagram
+
+        rawhrefs = tuple(node.href for node in diagram.traverse_nodes())
+        hrefs = resolve_references(builder, rawhrefs, standalone)
+        if hrefs == rawhrefs:
+            return diagram
+        else:
+            _, diagram = build_diagram(self['code'], self.get('timings'), hrefs)
+            return diagram
+
+    def to_drawer(self, image_format, builder, standalone=False, **kwargs):
+        """Returns the drawer of the diagram.
+
+        If *standalone* is true, the links are resolved relative to the image
+        directory; the image is shared between pages as a separate file.
+        """
         if 'filename' in kwargs:
             filename = kwargs.pop('filename')
         else:
             filename = self.get_abspath(image_format, builder)
 
-        antialias = builder.config.actdiag_antialias
-        transparency = builder.config.actdiag_transparency
-        image = super(actdiag_node, self).to_drawer(image_format, filename, fontmap,
-                                                    antialias=antialias, transparency=transparency,
-                                                    **kwargs)
-        for node in image.diagram.traverse_nodes():
-            node.href = resolve_reference(builder, node.href)
-
-        return image
+        diagram = self.to_diagram(builder, standalone)
+        return builder.app.actdiag_renderer.create_drawer(self, image_format, filename,
+                                                          diagram=diagram, **kwargs)
+
+    def to_layout(self, builder, standalone=False):
+        """Returns the page size and the cells of nodes of the diagram.
+
+        They are calculated from the laid out diagram; no drawers (and no
+        canvases) are created.  The cells are pairs of the resolved hrefs of
+        drawable nodes and their boxes in the image of 1x.  The render
+        server lays out the diagram if available.
+        """
+        from blockdiag.utils import Box, Size
+
+        client = getattr(builder.app, 'actdiag_render_client', None)
+        if client:
+            try:
+                result = client.request('layout', code=self['code'])
+                self['code'] = result['code']
+                hrefs = resolve_references(builder, [href for href, _ in result['cells']], standalone)
+                cells = [(href, Box(*box)) for href, (_, box) in zip(hrefs, result['cells'])]
+                return DiagramLayout(Size(*result['pagesize']), cells)
+            except OSError:
+                pass  # fall back to in-process
+
+        diagram = self.to_diagram(builder, standalone)
+        return get_layout(diagram)
+
+    def create_drawer(self, image_format, filename, fontmap, scale=1, diagram=None, **kwargs):
+        if image_format.upper() == 'PDF':
+            install_pdf_font_cache()
+
+        if diagram is None:
+            diagram = self.to_diagram()
+        if scale != 1:
+            return get_scaled_drawer_class()(image_format, diagram, filename,
+                                             scale=scale, fontmap=fontmap, **kwargs)
+        elif image_format.upper() == 'PDF':
+            # do not embed timestamps and random IDs into PDF
+            with pdf_invariant_mode():
+                return get_processor().drawer.DiagramDraw(image_format, diagram, filename,
+                                                          fontmap=fontmap, **kwargs)
+        else:
+            return get_processor().drawer.DiagramDraw(image_format, diagram, filename,
+                                                      fontmap=fontmap, **kwargs)
+
+    def to_render_job(self, image_format, builder, scales=(1,)):
+        config = builder.config
+        filename = self.get_abspath(image_format, builder)
+        return RenderJob(self['code'], self['options'], image_format, filename,
+                         config.actdiag_antialias, config.actdiag_transparency,
+                         config.actdiag_fontpath, config.actdiag_fontmap, tuple(scales),
+                         get_lock_dir(builder.app), config.actdiag_max_canvas_pixels)
+
+    def get_options(self, image_format, builder):
+        """Returns the settings of the image for the builder; they are hashed into its filename."""
+        config = builder.config
+        options = dict(antialias=config.actdiag_antialias,
+                       fontpath=config.actdiag_fontpath,
+                       fontmap=config.actdiag_fontmap,
+                       format=image_format,
+                       transparency=config.actdiag_transparency)
+
+        if image_format.upper() == 'PNG' and config.actdiag_max_canvas_pixels:
+            # oversized images are downsampled (see fit_canvas())
+            options['max_canvas_pixels'] = int(config.actdiag_max_canvas_pixels)
+        if image_format.upper() == 'PNG' and builder.format in ('html', 'slides'):
+            # PNG images are optimized in place (see postprocess_image())
+            if config.actdiag_png_optimize:
+                options['optimize'] = True
+            if config.actdiag_png_quantize:
+                options['quantize'] = True
+        if (image_format.upper() == 'SVG' and builder.format in ('html', 'slides') and
+                config.actdiag_html_svg_mode == 'external'):
+            # the files are written by save_svg() (see html_render_svg_external())
+            if config.actdiag_svg_minify:
+                options['minify'] = True
+            if config.actdiag_svg_precision is not None:
+                options['precision'] = int(config.actdiag_svg_precision)
+
+        return options
 
     def get_relpath(self, image_format, builder):
-        options = dict(antialias=builder.config.actdiag_antialias,
-                       fontpath=builder.config.actdiag_fontpath,
-                       fontmap=builder.config.actdiag_fontmap,
-                       format=image_format,
-                       transparency=builder.config.actdiag_transparency)
+        options = self.get_options(image_format, builder)
         if hasattr(builder, 'imgpath'):  # Sphinx (<= 1.2.x) or HTML writer
             outputdir = builder.imgpath
         else:
@@ -65,12 +221,7 @@ class actdiag_node(actdiag.utils.rst.nodes.actdiag):
         return posixpath.join(outputdir, self.get_path(**options))
 
     def get_abspath(self, image_format, builder):
-        options = dict(antialias=builder.config.actdiag_antialias,
-                       fontpath=builder.config.actdiag_fontpath,
-                       fontmap=builder.config.actdiag_fontmap,
-                       format=image_format,
-                       transparency=builder.config.actdiag_transparency)
-
+        options = self.get_options(image_format, builder)
         if hasattr(builder, 'imagedir'):  # Sphinx (>= 1.3.x)
             outputdir = os.path.join(builder.outdir, builder.imagedir)
         elif hasattr(builder, 'imgpath'):  # Sphinx (<= 1.2.x) and HTML writer
@@ -82,43 +233,956 @@ class actdiag_node(actdiag.utils.rst.nodes.actdiag):
 
         return path
 
+    def get_path(self, **options):
+        options.update(self['options'])
+        hashseed = (self['code'] + str(options)).encode('utf-8')
+        hashed = sha1(hashseed).hexdigest()
+
+        filename = "%s-%s.%s" % (self.name, hashed, options['format'].lower())
+        outputdir = options.get('outputdir')
+        if outputdir:
+            filename = os.path.join(outputdir, filename)
+
+        return filename
+
+
+def get_layout(diagram):
+    """Returns the page size and the cells of nodes of the diagram (see to_layout())."""
+    metrics = get_processor().metrics.DiagramMetrics(diagram)
+    cells = [(node.href, metrics.cell(node)) for node in diagram.traverse_nodes() if node.drawable]
+    return DiagramLayout(metrics.pagesize(diagram.colwidth, diagram.colheight), cells)
+
+
+def get_processor():
+    """Returns the actdiag package after loading its parser, builder and drawer."""
+    import actdiag.builder
+    import actdiag.drawer
+    import actdiag.metrics
+    import actdiag.parser
+
+    return actdiag
+
+
+def build_diagram(code, timings=None, hrefs=None):
+    """Parse and lay out the code of diagram.
+
+    The result is cached; the directive, writers and render pool reuse it.
+    Returns the parsed code (it might be surrounded by ``actdiag { }``) and
+    the diagram.  If *timings* is given, the time spent on parsing and
+    layout is added to it.  If *hrefs* is given, the hrefs of nodes are
+    replaced by them; such diagrams are cached separately.
+
+    It is serialized by a lock; the layout depends on global state of blockdiag.
+    """
+    key = code if hrefs is None else (code, hrefs)
+    with blockdiag_lock:
+        if key in diagram_cache:
+            diagram_cache.move_to_end(key)
+        else:
+            processor = get_processor()
+            started = time.perf_counter()
+            try:
+                parsed = code
+                tree = processor.parser.parse_string(parsed)
+            except Exception:
+                parsed = '%s { %s }' % (actdiag_node.name, code)
+                tree = processor.parser.parse_string(parsed)
+
+            parsed_at = time.perf_counter()
+            with stable_element_ids(parsed):
+                diagram = processor.builder.ScreenNodeBuilder.build(tree)
+            if timings is not None:
+                timings['parse'] = timings.get('parse', 0.0) + parsed_at - started
+                timings['layout'] = timings.get('layout', 0.0) + time.perf_counter() - parsed_at
+
+            if hrefs is None:
+                diagram_cache[code] = diagram_cache[parsed] = (parsed, diagram)
+            else:
+                for node, href in zip(diagram.traverse_nodes(), hrefs):
+                    node.href = href
+                diagram_cache[key] = diagram_cache[(parsed, hrefs)] = (parsed, diagram)
+
+            while len(diagram_cache) > DIAGRAM_CACHE_SIZE:
+                diagram_cache.popitem(last=False)
+
+        return diagram_cache[key]
+
+
+@contextmanager
+def stable_element_ids(seed):
+    """Derive the IDs of anonymous elements (ex. lanes) from *seed* while building a diagram.
+
+    blockdiag assigns uuid1() to them, and they might be drawn as labels.
+    The generator is global state of blockdiag; it is swapped for a single
+    build of diagram, and ``blockdiag_lock`` is held until it is restored.
+    The diagrams of this extension are built under the lock (see
+    ``build_diagram()``), so other threads never get the seeded IDs.
+    """
+    from blockdiag.utils import uuid as uuid_generator
+
+    counter = itertools.count()
+
+    def generate():
+        hashseed = ('%s\0%d' % (seed, next(counter))).encode('utf-8')
+        return str(uuid.UUID(bytes=sha1(hashseed).digest()[:16]))
+
+    with blockdiag_lock:
+        original = uuid_generator.generate
+        uuid_generator.generate = generate
+        try:
+            yield
+        finally:
+            uuid_generator.generate = original
+
+
+@contextmanager
+def pdf_invariant_mode():
+    """Create the canvases of PDF in the invariant mode of reportlab.
+
+    The mode is a global setting of reportlab, and a canvas takes it on
+    creation; it is restored on leaving, so that other users of reportlab
+    are not affected.
+    """
+    from reportlab import rl_config
+
+    with blockdiag_lock:
+        invariant = rl_config.invariant
+        rl_config.invariant = 1
+        try:
+            yield
+        finally:
+            rl_config.invariant = invariant
+
+
+@lru_cache(maxsize=None)
+def get_directive_class():
+    """Returns the implementation of the actdiag directive."""
+    from actdiag.utils.rst.directives import ActdiagDirective
+
+    class ActdiagDirectiveImpl(ActdiagDirective):
+        node_class = actdiag_node
+
+        def run(self):
+            # the run() of blockdiag enters (and leaves) its own application
+            # context; it clears the state of blockdiag used by other threads
+            with blockdiag_context:
+                return ActdiagDirective.run.__wrapped__(self)
+
+        def node2diagram(self, node):
+            env = getattr(self.state.document.settings, 'env', None)
+            if env and env.config.actdiag_profile:
+                node['timings'] = {}
+
+            return super(ActdiagDirectiveImpl, self).node2diagram(node)
+
+        def node2image(self, node, diagram):
+            node.source, node.line = self.state_machine.get_source_and_line(self.lineno)
+            return node
+
+    return ActdiagDirectiveImpl
+
+
+@lru_cache(maxsize=None)
+def get_scaled_drawer_class():
+    """Returns a drawer rendering PNG images at an integral scale factor.
+
+    The diagram is drawn on a canvas *scale* times larger than usual (and
+    twice more on antialiasing), so that the laid out diagram is reused for
+    HiDPI images.  The drawer is set up by the constructor of actdiag, and
+    then its scale ratio is raised.
+    """
+    from blockdiag.metrics import AutoScaler
+    from blockdiag.utils import Size
+
+    class ScaledDiagramDraw(get_processor().drawer.DiagramDraw):
+        def __init__(self, _format, diagram, filename=None, scale=1, **kwargs):
+            if _format.upper() != 'PNG' or int(scale) != scale or scale < 1:
+                raise ValueError('could not scale %s image by %r' % (_format, scale))
+
+            super(ScaledDiagramDraw, self).__init__(_format, diagram, filename, **kwargs)
+            self.scale = int(scale)
+            if self.scale == 1:
+                return
+
+            # the canvas is resized to the scaled page size on drawing (see draw())
+            self.scale_ratio *= self.scale
+            getattr(self.drawer, 'target', self.drawer).scale_ratio = self.scale_ratio
+            self.metrics = AutoScaler(self.metrics.original_metrics, scale_ratio=self.scale_ratio)
+            self.drawer.set_options(jump_radius=self.metrics.cellsize / 2)
+
+        def save(self, size=None):
+            if size is None:
+                pagesize = self.pagesize()
+                size = Size(pagesize.width * self.scale, pagesize.height * self.scale)
+
+            return self.drawer.save(self.filename, size, self.format)
+
+    return ScaledDiagramDraw
+
+
+class DirectiveOptionSpec(Mapping):
+    """The option_spec of the actdiag directive; loaded on the first access."""
+
+    def __getitem__(self, key):
+        return get_directive_class().option_spec[key]
+
+    def __iter__(self):
+        return iter(get_directive_class().option_spec)
+
+    def __len__(self):
+        return len(get_directive_class().option_spec)
+
+
+class Actdiag(rst.Directive):
+    """The actdiag directive.
+
+    It delegates to the directive of actdiag, which is loaded on the first use.
+    """
+    has_content = True
+    required_arguments = 0
+    optional_arguments = 1
+    final_argument_whitespace = False
+    option_spec = DirectiveOptionSpec()
+
+    def run(self):
+        directive = get_directive_class()(self.name, self.arguments, self.options,
+                                          self.content, self.lineno, self.content_offset,
+                                          self.block_text, self.state, self.state_machine)
+        return directive.run()
+
+
+class BlockdiagContext(object):
+    """The application context of blockdiag shared by threads.
+
+    blockdiag keeps plugins and downloaded images in global state, and
+    clears them on leaving its context.  The context is entered by the first
+    thread and left by the last one, so that it is not cleared during
+    rendering diagrams in other threads.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.users = 0
+
+    def __enter__(self):
+        with blockdiag_lock:
+            if self.users == 0:
+                from blockdiag import imagedraw, noderenderer
+                from blockdiag.utils.bootstrap import Application
+
+                self.app = Application()
+                self.app.__enter__()
+
+                # load the drawers and renderers at once; they are lazily
+                # loaded on first use, but it is not thread-safe.
+                if not imagedraw.drawers:
+                    imagedraw.init_imagedrawers()
+                if not noderenderer.renderers:
+                    noderenderer.init_renderers()
+
+            self.users += 1
+        return self
+
+    def __exit__(self, *args):
+        with blockdiag_lock:
+            self.users -= 1
+            if self.users == 0:
+                app, self.app = self.app, None
+                app.__exit__(*args)
+
+
+blockdiag_context = BlockdiagContext()
+
+
+def with_blockdiag(fn):
+    """Calls *fn* within the application context of blockdiag."""
+    @wraps(fn)
+    def decorator(*args, **kwargs):
+        with blockdiag_context:
+            return fn(*args, **kwargs)
+
+    return decorator
+
+
+class DiagramRenderer(object):
+    """Fonts and settings to draw diagrams for a Sphinx application.
+
+    A renderer is created for each application on builder-inited event, and
+    for each settings of jobs in the render pool (see ``get_job_renderer()``).
+    The fontmap is created on the first use.  It is safe to share between
+    threads.  PNG canvases are limited to *max_canvas_pixels* if given (see
+    ``fit_canvas()``).
+    """
+
+    def __init__(self, fontpath=None, fontmappath=None, antialias=False, transparency=True,
+                 max_canvas_pixels=None):
+        self.fontpath = fontpath
+        self.fontmappath = fontmappath
+        self.antialias = antialias
+        self.transparency = transparency
+        self.max_canvas_pixels = max_canvas_pixels
+        self.lock = threading.Lock()
+        self._fontmap = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.actdiag_fontpath, config.actdiag_fontmap,
+                   config.actdiag_antialias, config.actdiag_transparency,
+                   config.actdiag_max_canvas_pixels)
+
+    @property
+    def fontmap(self):
+        with self.lock:
+            if self._fontmap is None:
+                self._fontmap = create_fontmap(self.fontpath, self.fontmappath)
+
+            return self._fontmap
+
+    def create_drawer(self, node, image_format, filename, **kwargs):
+        """Returns the drawer of the diagram of *node*."""
+        install_font_cache()
+        antialias = self.antialias
+        if self.max_canvas_pixels and image_format.upper() == 'PNG':
+            if kwargs.get('diagram') is None:
+                kwargs['diagram'] = node.to_diagram()
+            pagesize = get_layout(kwargs['diagram']).pagesize
+            kwargs['scale'], antialias = fit_canvas(pagesize, kwargs.get('scale', 1), antialias,
+                                                    int(self.max_canvas_pixels))
+
+        return node.create_drawer(image_format, filename, self.fontmap,
+                                  antialias=antialias, transparency=self.transparency,
+                                  **kwargs)
+
+
+@lru_cache(maxsize=None)
+def get_job_renderer(fontpath, fontmappath, antialias, transparency, max_canvas_pixels=None):
+    """Returns a renderer shared by jobs having the same settings in the process."""
+    if isinstance(fontpath, tuple):
+        fontpath = list(fontpath)
+
+    return DiagramRenderer(fontpath, fontmappath, antialias, transparency, max_canvas_pixels)
+
+
+def fit_canvas(pagesize, scale, antialias, max_pixels):
+    """Returns the scale factor and the antialias flag to draw a PNG image within *max_pixels*.
+
+    The canvas of a PNG image is *scale* times larger than *pagesize* (and
+    twice more on antialiasing).  Oversized images are downsampled; the
+    antialiasing is dropped at first, and then the scale factor is lowered
+    (the HiDPI images get blurred, but are displayed at the same size).
+    Raises ValueError if the image does not fit even at 1x.
+    """
+    def pixels(scale, antialias):
+        ratio = scale * 2 if antialias else scale
+        return pagesize.width * pagesize.height * ratio * ratio
+
+    if pixels(scale, antialias) <= max_pixels:
+        return scale, antialias
+    elif antialias and pixels(scale, False) <= max_pixels:
+        logger.verbose('actdiag: drawing %dx%d image at %dx without antialiasing',
+                       pagesize.width, pagesize.height, scale)
+        return scale, False
+
+    for smaller in range(scale - 1, 0, -1):
+        if pixels(smaller, False) <= max_pixels:
+            logger.verbose('actdiag: drawing %dx%d image at %dx instead of %dx',
+                           pagesize.width, pagesize.height, smaller, scale)
+            return smaller, False
+
+    raise ValueError('diagram is too large: %dx%d pixels exceeds actdiag_max_canvas_pixels (%d)' %
+                     (pagesize.width, pagesize.height, max_pixels))
+
+
+class ImageCache(object):
+    """Persistent image cache shared between builds and output directories.
+
+    The filename of an image contains a hash of its source code and settings
+    (see ``get_path()``), so the cache is addressed by the basename of images.
+    A miss is counted once per image until the counters are reset.
+    """
+
+    def __init__(self, cachedir, maxsize=None):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.missed = set()
+        ensuredir(cachedir)
+
+    def reset_counters(self):
+        self.hits = self.misses = 0
+        self.missed.clear()
+
+    def miss(self, filename):
+        if filename not in self.missed:
+            self.missed.add(filename)
+            self.misses += 1
+
+    def fetch(self, filename):
+        """Place the cached image at *filename*.  Returns True on cache hit."""
+        cached = os.path.join(self.cachedir, os.path.basename(filename))
+        if not os.path.isfile(cached):
+            self.miss(filename)
+            return False
+
+        try:
+            link_or_copy(cached, filename)
+            os.utime(cached)  # refresh the entry for LRU eviction
+        except OSError:
+            self.miss(filename)
+            return False
+
+        self.hits += 1
+        return True
+
+    def store(self, filename, update=False):
+        cached = os.path.join(self.cachedir, os.path.basename(filename))
+        try:
+            if update or not os.path.isfile(cached):
+                link_or_copy(filename, cached)
+        except OSError as exc:
+            logger.warning('actdiag error: could not store %s to cache: %s', filename, exc)
+
+    def evict(self):
+        """Remove least recently used images until the cache fits in maxsize."""
+        if not self.maxsize:
+            return
+
+        entries = []
+        for entry in os.scandir(self.cachedir):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class DiagramProfiler(object):
+    """Records the time spent on each diagram (enabled by ``actdiag_profile``).
+
+    A record is kept per location and image format of the diagrams.  Images
+    shared by several diagrams are accounted to the one rendered them.  The
+    diagrams rendered on writing pages in parallel (``-j``), and rendered
+    ahead of writing (``actdiag_render_ahead``) are not recorded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.records = OrderedDict()
+        self.owners = {}  # filename -> the record of the diagram rendering it
+        self.profile = None  # cProfile.Profile (if actdiag_profile_output is not JSON)
+
+    def get_record(self, node, image_format):
+        """Returns the record of *node*.
+
+        The time of parsing and layout on writing is also added to the record.
+        """
+        key = (node.source, node.line, image_format.upper())
+        record = self.records.get(key)
+        if record is None:
+            docname = node.source and self.app.env.path2doc(node.source)
+            record = dict(docname=docname or node.source, line=node.line,
+                          hash=get_diagram_key(node), format=key[2])
+            record.update(dict.fromkeys(PHASES, 0.0))
+            timings = getattr(self.app.env, 'actdiag_timings', {})
+            record.update(timings.get((node.source, node.line), {}))
+            self.records[key] = record
+
+        node['timings'] = record
+        return record
+
+    @contextmanager
+    def measure(self, node, image_format, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.get_record(node, image_format)[phase] += time.perf_counter() - started
+
+    def assign(self, filename, node, image_format):
+        """Account the rendering of *filename* (in the render pool) to *node*."""
+        self.owners.setdefault(filename, self.get_record(node, image_format))
+
+    def add(self, filename, timings):
+        record = self.owners.pop(filename, None)
+        if record is not None:
+            for phase in PHASES:
+                record[phase] += timings.get(phase, 0.0)
+
+    def ranking(self):
+        return sorted(self.records.values(), key=lambda r: sum(r[p] for p in PHASES), reverse=True)
+
+    def report(self, top):
+        ranking = self.ranking()
+        logger.info('actdiag profile: %d diagrams, %.3fs in total; top %d:',
+                    len(ranking), sum(sum(r[p] for p in PHASES) for r in ranking), min(top, len(ranking)))
+        for record in ranking[:top]:
+            logger.info('  %.3fs %s:%s %s %s (parse %.3fs, layout %.3fs, draw %.3fs, save %.3fs)',
+                        sum(record[p] for p in PHASES), record['docname'], record['line'],
+                        record['format'], record['hash'][:12], record['parse'], record['layout'],
+                        record['draw'], record['save'])
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.ranking(), f, indent=2)
+
+
+def profile(builder, node, image_format, phase):
+    """Returns a context manager to measure the *phase* of rendering *node*."""
+    profiler = getattr(builder.app, 'actdiag_profiler', None)
+    if profiler is None or node is None:
+        return nullcontext()
+    else:
+        return profiler.measure(node, image_format, phase)
+
+
+def get_temp_path(filename):
+    """Returns a temporary filename to write *filename* atomically (via ``os.replace()``)."""
+    return '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+
+
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        # copy via a temporary file not to leave incomplete images
+        tmpname = get_temp_path(dest)
+        shutil.copyfile(src, tmpname)
+        os.replace(tmpname, dest)
+
+
+def get_cache_path(app, filename):
+    cache = getattr(app, 'actdiag_cache', None)
+    if cache is None:
+        return None
+    else:
+        return os.path.join(cache.cachedir, os.path.basename(filename))
+
+
+def find_image(builder, filename):
+    """Returns True if the image has already been rendered (or cached)."""
+    if os.path.isfile(filename):
+        return True
+
+    cache = getattr(builder.app, 'actdiag_cache', None)
+    return cache is not None and cache.fetch(filename)
+
+
+def store_image(builder, filename, update=False):
+    cache = getattr(builder.app, 'actdiag_cache', None)
+    if cache is not None:
+        cache.store(filename, update)
+
+
+def get_lock_dir(app):
+    return os.path.join(app.doctreedir, 'actdiag_locks')
+
+
+@contextmanager
+def render_lock(lockdir, filename):
+    """Lock the image while rendering it; it is shared between processes (and threads).
+
+    The images are locked by one of ``LOCK_BUCKETS`` files chosen by their
+    filenames; rendering the images sharing the lock files is serialized.
+    """
+    ensuredir(lockdir)
+    bucket = int(sha1(os.path.basename(filename).encode('utf-8')).hexdigest(), 16) % LOCK_BUCKETS
+    with open(os.path.join(lockdir, '%02x.lock' % bucket), 'w') as lockfile:
+        if fcntl:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def render_on_demand(builder, filename, create_image, node=None, save=None, force=False):
+    """Draw and save the image created by *create_image* unless it has already been rendered.
+
+    On parallel writing, the same diagram might be rendered by other workers
+    at the same time.  The image is locked and checked again before drawing.
+    If *save* is given, it is called with the image instead of ``image.save()``.
+
+    *create_image* is called only if *filename* has not been rendered (nor cached) yet;
+    the drawer and its canvas are not created for rendered images.  They
+    are released just after saved; up to ``MAX_LIVE_RENDERS`` of them are
+    alive at the same time.  If *force* is true, the image is rendered even
+    if it exists; it is not stored into the image cache.
+    """
+    if not force and find_image(builder, filename):
+        return
+
+    with render_lock(get_lock_dir(builder.app), filename):
+        if force or not os.path.isfile(filename):
+            with render_slots:
+                image = create_image()
+                try:
+                    with profile(builder, node, image.format, 'draw'):
+                        image.draw()
+                    with profile(builder, node, image.format, 'save'):
+                        save_image(image, save)
+                finally:
+                    release_image(image)
+            if not force:
+                store_image(builder, filename)
+
+
+def save_image(image, save=None):
+    """Save the drawn image to a temporary file, then move it to ``image.filename``.
+
+    Incomplete images are never seen by other workers (and by later builds);
+    they are cleaned up on errors.  If *save* is given, it is called with the
+    image instead of ``image.save()``.
+    """
+    filename = image.filename
+    tmpname = get_temp_path(filename)
+    if image.format == 'PDF':
+        # the PDF canvas of reportlab is bound to the filename on creation
+        pdf = getattr(image.drawer, 'target', image.drawer)
+
+        def save_pdf(filename, size, _format):
+            pdf.canvas.showPage()
+            with open(tmpname, 'wb') as f:
+                f.write(pdf.canvas.getpdfdata())
+
+        pdf.save = save_pdf
 
-class Actdiag(actdiag.utils.rst.directives.ActdiagDirective):
-    node_class = actdiag_node
+    try:
+        image.filename = tmpname
+        if save:
+            save(image)
+        else:
+            image.save()
+        os.replace(tmpname, filename)
+    finally:
+        image.filename = filename
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def release_image(image):
+    """Release the canvas and the diagram of the drawer; it can not be used after that.
+
+    The canvas of large diagram takes a lot of memory; it should not be
+    kept alive until the drawer is collected.
+    """
+    drawer = getattr(image.drawer, 'target', image.drawer)  # unwrap filters (ex. linejump)
+    canvas = getattr(drawer, '_image', None)
+    if canvas is not None:  # PNG
+        canvas.close()
+        drawer._image = drawer.draw = None
+    if getattr(drawer, 'canvas', None) is not None:  # PDF
+        drawer.canvas = None
+
+    image.drawer = image.metrics = image.diagram = None
+
+
+def get_png_scales(builder):
+    """Returns the scale factors of PNG images for the builder; 1x comes first."""
+    if builder.format not in ('html', 'slides'):
+        return [1]
+    else:
+        return parse_png_scales(builder.config.actdiag_png_scales)
+
+
+def parse_png_scales(values):
+    """Returns the scale factors of ``actdiag_png_scales``; 1x comes first.
+
+    Raises ValueError if they are not positive integers.
+    """
+    scales = set([1])
+    for scale in values or []:
+        try:
+            valid = float(scale) == int(float(scale)) and int(float(scale)) >= 1
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            raise ValueError('actdiag_png_scales must be positive integers: %r' % scale)
+        scales.add(int(float(scale)))
 
-    def node2image(self, node, diagram):
-        return node
+    return sorted(scales)
 
 
-def resolve_reference(builder, href):
+def get_scaled_path(filename, scale):
+    """Returns the filename of the image scaled by *scale* (ex. ``actdiag-xxx@2x.png``)."""
+    if scale == 1:
+        return filename
+    else:
+        basename, ext = os.path.splitext(filename)
+        return '%s@%dx%s' % (basename, scale, ext)
+
+
+def resolve_references(builder, hrefs, standalone=False):
+    """Resolve *hrefs* of a diagram at once; returns a tuple of them."""
+    resolved = {}
+    for href in hrefs:
+        if href not in resolved:
+            resolved[href] = resolve_reference(builder, href, standalone)
+
+    return tuple(resolved[href] for href in hrefs)
+
+
+def resolve_reference(builder, href, standalone=False):
     if href is None:
         return None
 
-    pattern = re.compile("^:ref:`(.+?)`", re.UNICODE)
-    matched = pattern.search(href)
+    matched = REFERENCE.search(href)
     if matched is None:
-        return href
+        if standalone and not ABSOLUTE_URI.match(href):
+            # relative links in standalone images are relative to the root of output
+            return posixpath.join(get_image_root(builder, builder.config.master_doc), href)
+        else:
+            return href
     elif not hasattr(builder, 'current_docname'):  # ex. latex builder
         return matched.group(1)
     else:
         refid = matched.group(1)
+        if standalone:
+            docname = builder.config.master_doc
+        else:
+            docname = builder.current_docname
+
+        uri = resolve_label(builder, docname, refid)
+        if uri and standalone:
+            if uri.startswith('#'):
+                uri = posixpath.basename(builder.get_target_uri(docname)) + uri
+            return posixpath.join(get_image_root(builder, docname), uri)
+        else:
+            return uri
+
+
+def resolve_label(builder, docname, refid):
+    """Returns the URI of the label *refid* from *docname* (or None if undefined).
+
+    The results are memoized during the build, and undefined labels are
+    warned only once.
+    """
+    app = builder.app
+    key = (docname, refid)
+    if key not in app.actdiag_labels:
         domain = builder.env.domains['std']
         node = addnodes.pending_xref(refexplicit=False)
-        xref = domain.resolve_xref(builder.env, builder.current_docname, builder,
+        xref = domain.resolve_xref(builder.env, docname, builder,
                                    'ref', refid, node, node)
-        if xref:
-            if 'refid' in xref:
-                return "#" + xref['refid']
-            else:
-                return xref['refuri']
+        if xref is None:
+            app.actdiag_labels[key] = None
+        elif 'refid' in xref:
+            app.actdiag_labels[key] = "#" + xref['refid']
         else:
-            logger.warning('undefined label: %s', refid)
-            return None
+            app.actdiag_labels[key] = xref['refuri']
+
+    uri = app.actdiag_labels[key]
+    if uri is None and refid not in app.actdiag_undefined_labels:
+        app.actdiag_undefined_labels.add(refid)
+        logger.warning('undefined label: %s', refid)
+
+    return uri
+
+
+def get_image_root(builder, docname):
+    """Returns the relative path from the image directory to the directory of *docname*."""
+    basedir = posixpath.dirname(builder.get_target_uri(docname))
+    return posixpath.relpath(basedir or '.', builder.imagedir)
+
+
+def write_svg(image, size, out, minify=False, precision=None, target=None):
+    """Write the drawn SVG image into *out* (a file-like object).
+
+    If *minify* is true, the markup is written without indentation and
+    redundant attributes.  If *precision* is given, the coordinates are
+    rounded to the number of decimal places.  If *target* is given, it is
+    set to the links.
+    """
+    from blockdiag.imagedraw import simplesvg
+
+    # the filters of drawer (ex. line jumps) replay drawing operations on saving;
+    # run them without serializing the whole markup into a string
+    drawer = image.drawer
+    svg_drawer = getattr(drawer, 'target', drawer)
+    svg_drawer.save = lambda filename, size, _format: None
+    drawer.save(None, None, 'SVG')
+
+    root = svg_drawer.svg
+    if size:
+        root.attributes['width'] = size[0]
+        root.attributes['height'] = size[1]
+
+    if target:
+        for anchor in iter_svg_elements(root, 'a'):
+            anchor.attributes['target'] = target
+
+    if minify or precision is not None:
+        write_svg_element(root, out, minify, precision)
+    else:
+        simplesvg.base.to_xml(root, out)
+
+
+def save_svg(image, filename, minify=False, precision=None, target=None):
+    """Save the drawn SVG image to *filename* (see write_svg())."""
+    with open(filename, 'w', encoding='utf-8') as out:
+        out.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        if not minify:
+            url = "http://www.w3.org/TR/2001/REC-SVG-20010904/DTD/svg10.dtd"
+            out.write('<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.0//EN" "%s">\n' % url)
+
+        write_svg(image, None, out, minify, precision, target)
+
+
+def iter_svg_elements(element, tagname):
+    if element.__class__.__name__ == tagname:
+        yield element
+
+    for child in element.elements:
+        for matched in iter_svg_elements(child, tagname):
+            yield matched
+
+
+# attributes of SVG elements having coordinates and lengths
+SVG_GEOMETRY_ATTRIBUTES = frozenset(['x', 'y', 'width', 'height', 'cx', 'cy', 'rx', 'ry',
+                                     'points', 'd', 'textLength', 'viewBox', 'stdDeviation'])
+# attributes having the initial value, and metadata of Inkscape
+SVG_REDUNDANT_ATTRIBUTES = frozenset([('font-style', 'normal'), ('font-weight', 'normal')])
+SVG_REDUNDANT_PREFIXES = ('inkspace:', 'xmlns:inkspace')
+SVG_DECIMAL = re.compile(r'-?\d+\.\d+')
+SVG_RGB = re.compile(r'^rgb\((\d+),(\d+),(\d+)\)$')
+
+
+def format_svg_value(key, value, minify, precision):
+    if isinstance(value, float) or key in SVG_GEOMETRY_ATTRIBUTES:
+        def round_decimal(matched):
+            if precision is None:
+                number = matched.group(0)
+            else:
+                number = '%.*f' % (precision, float(matched.group(0)))
+            if '.' in number:
+                number = number.rstrip('0').rstrip('.')
+            return '0' if number == '-0' else number
+
+        return SVG_DECIMAL.sub(round_decimal, str(value))
+    elif minify:
+        matched = SVG_RGB.match(str(value))
+        if matched:
+            rgb = tuple(int(n) for n in matched.groups())
+            if all(n % 17 == 0 for n in rgb):
+                return '#%x%x%x' % tuple(n // 17 for n in rgb)
+            else:
+                return '#%02x%02x%02x' % rgb
+
+    return value
+
+
+def write_svg_element(element, out, minify, precision, level=0):
+    from blockdiag.imagedraw.simplesvg import _escape, _quote
+
+    tagname = element.__class__.__name__
+    indent = '' if minify else '  ' * level
+    newline = '' if minify else '\n'
+
+    out.write('%s<%s' % (indent, tagname))
+    for key in sorted(element.attributes):
+        value = element.attributes[key]
+        if value is None:
+            continue
+        elif minify and ((key, value) in SVG_REDUNDANT_ATTRIBUTES or key.startswith(SVG_REDUNDANT_PREFIXES)):
+            continue
+
+        value = format_svg_value(key, value, minify, precision)
+        out.write(' %s=%s' % (_escape(key), _quote(value)))
+
+    if element.elements:
+        text = '' if element.text is None else _escape(element.text)
+        out.write('>%s%s' % (text, newline))
+        for child in element.elements:
+            write_svg_element(child, out, minify, precision, level + 1)
+        out.write('%s</%s>%s' % (indent, tagname, newline))
+    elif element.text is not None:
+        out.write('>%s</%s>%s' % (_escape(element.text), tagname, newline))
+    else:
+        out.write(' />%s' % newline)
 
 
 def html_render_svg(self, node):
-    image = node.to_drawer('SVG', self.builder, filename=None, nodoctype=True)
-    image.draw()
+    config = self.builder.config
+    key = '%s;minify=%s;precision=%s' % (posixpath.basename(node.get_relpath('SVG', self.builder)),
+                                         config.actdiag_svg_minify, config.actdiag_svg_precision)
+    # the markup depends on the current document if it contains references;
+    # it is used only once, so it is not cached
+    cache = self.builder.app.actdiag_svg_cache
+    cacheable = ':ref:' not in node['code']
+
+    content = cache.get(key) if cacheable else None
+    if content is not None:
+        cache.move_to_end(key)
+    else:
+        image = node.to_drawer('SVG', self.builder, filename=None, nodoctype=True)
+        with profile(self.builder, node, 'SVG', 'draw'):
+            image.draw()
+
+        # resize image
+        size = image.pagesize().resize(**node['options'])
+
+        precision = config.actdiag_svg_precision
+        if precision is not None:
+            precision = int(precision)
+
+        # serialize the markup into a string; the body and the cache share it
+        out = io.StringIO()
+        with profile(self.builder, node, 'SVG', 'save'):
+            write_svg(image, size, out, config.actdiag_svg_minify, precision)
+        content = out.getvalue()
+        if cacheable:
+            cache[key] = content
+            while len(cache) > SVG_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    # align
+    align = node['options'].get('align', 'default')
+    self.body.append('<div class="align-%s">' % align)
+
+    # reftarget
+    for node_id in node['ids']:
+        self.body.append('<span id="%s"></span>' % node_id)
+
+    self.body.append(content)
+
+    self.context.append('</div>\n')
+    self.context.append('')
+
+
+def html_render_svg_external(self, node):
+    config = self.builder.config
+    # the page needs only the layout; the drawer is created if the image is missing
+    layout = node.to_layout(self.builder, standalone=True)
+
+    precision = config.actdiag_svg_precision
+    if precision is not None:
+        precision = int(precision)
+
+    def save(image):
+        save_svg(image, image.filename, config.actdiag_svg_minify, precision, target='_top')
+
+    # the drawer is released after rendered
+    filename = node.get_abspath('SVG', self.builder)
+    create_image = partial(node.to_drawer, 'SVG', self.builder, standalone=True, filename=filename)
+    if ':ref:' not in node['code']:
+        render_on_demand(self.builder, filename, create_image, node, save)
+    elif filename not in self.builder.app.actdiag_svg_files:
+        # the labels might have been moved; render it once in each build
+        render_on_demand(self.builder, filename, create_image, node, save, force=True)
+        self.builder.app.actdiag_svg_files.add(filename)
+
+    size = layout.pagesize.resize(**node['options'])
+    clickable = any(href for href, _ in layout.cells)
 
     # align
     align = node['options'].get('align', 'default')
@@ -129,36 +1193,53 @@ def html_render_svg(self, node):
     for node_id in node['ids']:
         self.body.append('<span id="%s"></span>' % node_id)
 
-    # resize image
-    size = image.pagesize().resize(**node['options'])
-    self.body.append(image.save(size))
+    # links in <img> are not clickable; use <object> instead
+    relpath = node.get_relpath('SVG', self.builder)
+    if clickable:
+        self.body.append(self.starttag(node, 'object', '', data=relpath, type='image/svg+xml',
+                                       width=size.width, height=size.height))
+        self.body.append('%s</object>' % self.encode(node['options'].get('alt', '')))
+    else:
+        img_attr = dict(src=relpath, width=size.width, height=size.height)
+        if 'alt' in node['options']:
+            img_attr['alt'] = node['options']['alt']
+        self.body.append(self.starttag(node, 'img', '', empty=True, **img_attr))
+
     self.context.append('')
 
 
-def html_render_clickablemap(self, image, width_ratio, height_ratio):
-    href_nodes = [node for node in image.nodes if node.href]
-    if not href_nodes:
+def html_render_clickablemap(self, layout, name, width_ratio, height_ratio):
+    href_cells = [(href, cell) for href, cell in layout.cells if href]
+    if not href_cells:
         return
 
-    self.body.append('<map name="map_%d">' % id(image))
-    for node in href_nodes:
-        x1, y1, x2, y2 = image.metrics.cell(node)
+    self.body.append('<map name="%s">' % name)
+    for href, cell in href_cells:
+        x1, y1, x2, y2 = cell
 
         x1 *= width_ratio
         x2 *= width_ratio
         y1 *= height_ratio
         y2 *= height_ratio
-        areatag = '<area shape="rect" coords="%s,%s,%s,%s" href="%s">' % (x1, y1, x2, y2, node.href)
+        areatag = '<area shape="rect" coords="%s,%s,%s,%s" href="%s">' % (x1, y1, x2, y2, href)
         self.body.append(areatag)
 
     self.body.append('</map>')
 
 
 def html_render_png(self, node):
-    image = node.to_drawer('PNG', self.builder)
-    if not os.path.isfile(image.filename):
-        image.draw()
-        image.save()
+    # the page needs only the layout; the drawer is created if the image is missing
+    layout = node.to_layout(self.builder)
+
+    # deferred images are rendered on build-finished event
+    scales = get_png_scales(self.builder)
+    if not use_deferred_render(self.builder.app):
+        abspath = node.get_abspath('PNG', self.builder)
+        for scale in scales:
+            # the diagram is laid out once; see build_diagram()
+            filename = get_scaled_path(abspath, scale)
+            create_image = partial(node.to_drawer, 'PNG', self.builder, filename=filename, scale=scale)
+            render_on_demand(self.builder, filename, create_image, node)
 
     # align
     align = node['options'].get('align', 'default')
@@ -174,31 +1255,59 @@ def html_render_png(self, node):
         self.context.append('')
 
     # <img> tag
-    original_size = image.pagesize()
+    original_size = layout.pagesize
     resized = original_size.resize(**node['options'])
     img_attr = dict(src=relpath,
                     width=resized.width,
                     height=resized.height)
 
-    if any(node.href for node in image.nodes):
-        img_attr['usemap'] = "#map_%d" % id(image)
+    if any(href for href, _ in layout.cells):
+        # the name is derived from the hash of image to make output reproducible
+        map_name = 'map_%s' % IMAGE_FILENAME.match(posixpath.basename(relpath)).group(1)
+        img_attr['usemap'] = "#" + map_name
 
         width_ratio = float(resized.width) / original_size.width
         height_ratio = float(resized.height) / original_size.height
-        html_render_clickablemap(self, image, width_ratio, height_ratio)
+        html_render_clickablemap(self, layout, map_name, width_ratio, height_ratio)
 
     if 'alt' in node['options']:
         img_attr['alt'] = node['options']['alt']
 
-    self.body.append(self.starttag(node, 'img', '', empty=True, **img_attr))
+    # HiDPI images share the size (and the clickable map) of the 1x image
+    if len(scales) > 1:
+        img_attr['srcset'] = ', '.join('%s %dx' % (get_scaled_path(relpath, scale), scale)
+                                       for scale in scales)
+
+    if self.builder.config.actdiag_html_webp:
+        # WebP images are generated on build-finished event
+        webp_relpath = get_webp_path(relpath)
+        if len(scales) > 1:
+            srcset = ', '.join('%s %dx' % (get_scaled_path(webp_relpath, scale), scale)
+                               for scale in scales)
+        else:
+            srcset = webp_relpath
+        self.body.append('<picture><source srcset="%s" type="image/webp" />' % srcset)
+        self.body.append(self.starttag(node, 'img', '', empty=True, **img_attr))
+        self.body.append('</picture>')
+    else:
+        self.body.append(self.starttag(node, 'img', '', empty=True, **img_attr))
 
 
 @with_blockdiag
 def html_visit_actdiag(self, node):
     try:
         image_format = get_image_format_for(self.builder)
+        if self.builder.app.actdiag_profiler:
+            self.builder.app.actdiag_profiler.get_record(node, image_format)
+
         if image_format.upper() == 'SVG':
-            html_render_svg(self, node)
+            svg_mode = self.builder.config.actdiag_html_svg_mode
+            if svg_mode == 'inline':
+                html_render_svg(self, node)
+            elif svg_mode == 'external':
+                html_render_svg_external(self, node)
+            else:
+                raise ValueError('unknown actdiag_html_svg_mode: %s' % svg_mode)
         else:
             html_render_png(self, node)
     except UnicodeEncodeError:
@@ -245,22 +1354,231 @@ def get_image_format_for(builder):
     return image_format
 
 
+def on_config_inited(self, config):
+    # validate settings at once; the images are rendered in the event handlers
+    try:
+        parse_png_scales(config.actdiag_png_scales)
+    except ValueError as exc:
+        from sphinx.errors import ConfigError
+        raise ConfigError(str(exc))
+
+
 def on_builder_inited(self):
     # show deprecated message
     if self.builder.config.actdiag_tex_image_format:
         logger.warning('actdiag_tex_image_format is deprecated. Use actdiag_latex_image_format.')
 
-    # initialize fontmap
-    global fontmap
+    # images to be rendered (and optimized) on build-finished event
+    self.actdiag_render_queue = {}
+    self.actdiag_postprocess_queue = set()
+
+    # rendered SVG markups (LRU; see html_render_svg()) and files having references
+    self.actdiag_svg_cache = OrderedDict()
+    self.actdiag_svg_files = set()
+    if self.builder.config.actdiag_svg_cache_persist:
+        load_svg_cache(self)
+
+    # resolved labels (see resolve_label())
+    self.actdiag_labels = {}
+    self.actdiag_undefined_labels = set()
+
+    # fonts and settings to draw diagrams of this application
+    self.actdiag_renderer = DiagramRenderer.from_config(self.builder.config)
+    self.actdiag_render_client = connect_render_server(self.builder.config.actdiag_render_server)
+
+    # renders images in background threads from doctree-read event; the threads
+    # are started on the first use, and stopped on build-finished event (see queue_render_ahead())
+    self.actdiag_render_ahead = None
+    self.actdiag_render_ahead_futures = {}
+
+    # render workers shared by the doctrees (see get_render_pool())
+    self.actdiag_render_pool = None
+
+    # per-diagram timings
+    if self.builder.config.actdiag_profile:
+        self.actdiag_profiler = DiagramProfiler(self)
+        if get_profile_output(self, 'prof'):
+            self.actdiag_profiler.profile = cProfile.Profile()
+            self.actdiag_profiler.profile.enable()
+    else:
+        self.actdiag_profiler = None
+
+    # initialize persistent image cache
+    if self.builder.config.actdiag_cache_dir:
+        cachedir = os.path.join(self.confdir, self.builder.config.actdiag_cache_dir)
+        self.actdiag_cache = ImageCache(cachedir, self.builder.config.actdiag_cache_size)
+    else:
+        self.actdiag_cache = None
+
+
+def get_profile_output(app, kind):
+    """Returns the path to dump the *kind* ('json' or 'prof') of profile into."""
+    output = app.builder.config.actdiag_profile_output
+    if output is None:
+        return None
+
+    is_json = output.lower().endswith('.json')
+    if is_json == (kind == 'json'):
+        return os.path.join(app.outdir, output)
+    else:
+        return None
+
+
+def get_svg_cache_path(app):
+    return os.path.join(app.doctreedir, 'actdiag_svg.pickle')
+
+
+def load_svg_cache(app):
+    try:
+        with open(get_svg_cache_path(app), 'rb') as f:
+            cache = pickle.load(f)
+        entries = [(key, content) for key, content in cache.items()
+                   if isinstance(key, str) and isinstance(content, str)]
+        app.actdiag_svg_cache = OrderedDict(entries[-SVG_CACHE_SIZE:])
+    except Exception:
+        pass  # no (or broken) cache file
+
+
+def save_svg_cache(app):
+    # the markups of diagrams no longer in the documents are dropped
+    basenames = set()
+    for entry in getattr(app.env, 'actdiag_manifest', {}).values():
+        node = actdiag_node(code=entry['code'], options=entry['options'])
+        basenames.add(posixpath.basename(node.get_relpath('SVG', app.builder)))
+
+    cache = OrderedDict((key, content) for key, content in app.actdiag_svg_cache.items()
+                        if key.split(';', 1)[0] in basenames)
+    try:
+        ensuredir(app.doctreedir)
+        with open(get_svg_cache_path(app), 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    except Exception as exc:
+        logger.warning('actdiag error: could not save SVG cache: %s', exc)
+
+
+def install_font_cache():
+    """Share loaded fonts and text metrics between all diagrams in the process.
+
+    The PNG drawer of blockdiag loads TrueType fonts on every drawing
+    operation, and it caches text metrics per drawer (and never releases
+    them).  This replaces them by process-wide caches keyed by font path,
+    size and string.  The originals are restored by ``uninstall_font_caches()``.
+    """
+    from blockdiag.imagedraw import png, svg
+
+    with blockdiag_lock:
+        if (png, 'ttfont_for') in font_cache_originals:
+            return  # already installed
+
+        ttfont_for = lru_cache(maxsize=256)(png.ttfont_for)
+        textlinesize = png.ImageDrawExBase.textlinesize.__wrapped__
+        measurer = png.ImageDrawEx(None)
+
+        @lru_cache(maxsize=65536)
+        def measure(string, font):
+            return textlinesize(measurer, string, font)
+
+        def cached_ttfont_for(font):
+            return ttfont_for(FontKey(font.path, font.size))
+
+        def cached_textlinesize(self, string, font, **kwargs):
+            return measure(string, FontKey(font.path, font.size))
+
+        def cache_clear():
+            ttfont_for.cache_clear()
+            measure.cache_clear()
+
+        cached_ttfont_for.cache_info = ttfont_for.cache_info
+        cached_ttfont_for.cache_clear = cache_clear
+        patch_font_function(png, 'ttfont_for', cached_ttfont_for)
+        patch_font_function(png.ImageDrawExBase, 'textlinesize', cached_textlinesize)
+        patch_font_function(svg.SVGImageDrawElement, 'textlinesize', cached_textlinesize)
+
+
+def install_pdf_font_cache():
+    """Register TrueType fonts to reportlab once in the process.
+
+    The PDF drawer of blockdiag loads and registers the fonts for each
+    diagram; it is the most of the time to render small diagrams.  This
+    shares the registered fonts between all drawers (reportlab keeps the
+    subsets of fonts per document).  The original is restored by
+    ``uninstall_font_caches()``.
+    """
+    from blockdiag.imagedraw import pdf
+
+    with blockdiag_lock:
+        if (pdf.PDFImageDraw, 'set_font') in font_cache_originals:
+            return  # already installed
+
+        ttfonts = {}
+
+        def set_font(self, font):
+            if font.path is None:
+                msg = "Could not detect fonts, use --font opiton\n"
+                raise RuntimeError(msg)
+
+            if font.path not in self.fonts:
+                with blockdiag_lock:
+                    if font.path not in ttfonts:
+                        path, index = pdf.parse_fontpath(font.path)
+                        if index:
+                            ttfont = pdf.TTFont(font.path, path, subfontIndex=index)
+                        else:
+                            ttfont = pdf.TTFont(font.path, path)
+                        pdf.pdfmetrics.registerFont(ttfont)
+                        ttfonts[font.path] = ttfont
+
+                self.fonts[font.path] = ttfonts[font.path]
+
+            self.canvas.setFont(font.path, font.size)
+
+        set_font.ttfonts = ttfonts
+        patch_font_function(pdf.PDFImageDraw, 'set_font', set_font)
+
+
+def patch_font_function(owner, name, func):
+    # keep the original to restore; call it with blockdiag_lock held
+    font_cache_originals[(owner, name)] = owner.__dict__[name]
+    setattr(owner, name, func)
+
+
+def uninstall_font_caches():
+    """Restore the functions of blockdiag replaced by the font caches.
+
+    blockdiag is shared with the other extensions (ex. sphinxcontrib-blockdiag)
+    in the process; the caches are installed again on the next drawing.
+    """
+    with blockdiag_lock:
+        for (owner, name), func in font_cache_originals.items():
+            setattr(owner, name, func)
+        font_cache_originals.clear()
+
+
+def clear_font_caches():
+    """Forget the fonts loaded in the process (see ``install_font_cache()``).
+
+    Call it after the font files are modified; they are loaded again on
+    the next drawing.
+    """
+    png = sys.modules.get('blockdiag.imagedraw.png')
+    pdf = sys.modules.get('blockdiag.imagedraw.pdf')
+    with blockdiag_lock:
+        if png and hasattr(png.ttfont_for, 'cache_clear'):
+            png.ttfont_for.cache_clear()
+        if pdf and hasattr(pdf.PDFImageDraw.set_font, 'ttfonts'):
+            pdf.PDFImageDraw.set_font.ttfonts.clear()
+
+
+def create_fontmap(fontpath, fontmappath):
+    from blockdiag.utils.bootstrap import detectfont
+    from blockdiag.utils.fontmap import FontMap
 
     try:
-        fontmappath = self.builder.config.actdiag_fontmap
         fontmap = FontMap(fontmappath)
     except Exception:
         fontmap = FontMap(None)
 
     try:
-        fontpath = self.builder.config.actdiag_fontpath
         if isinstance(fontpath, str):
             fontpath = [fontpath]
 
@@ -271,9 +1589,606 @@ def on_builder_inited(self):
     except Exception:
         pass
 
+    return fontmap
+
+
+def render_image(job):
+    """Draw a diagram and save it to ``job.filename``.
+
+    This is the entry point of the render pool; it is self-contained so that
+    it can run in a worker process.  The diagram is also saved at each of
+    ``job.scales`` from the same layout; images already rendered are skipped.
+    The images are locked and written atomically like ``render_on_demand()``.
+    """
+    if isinstance(job.fontpath, list):
+        fontpath = tuple(job.fontpath)
+    else:
+        fontpath = job.fontpath
+    renderer = get_job_renderer(fontpath, job.fontmap, job.antialias, job.transparency,
+                                job.max_canvas_pixels)
+
+    node = actdiag_node(code=job.code, options=job.options, timings={})
+    timings = dict.fromkeys(('draw', 'save'), 0.0)
+    with blockdiag_context:
+        for scale in job.scales:
+            filename = get_scaled_path(job.filename, scale)
+            with render_lock(job.lockdir, filename):
+                if os.path.isfile(filename):
+                    continue
+
+                with render_slots:
+                    image = renderer.create_drawer(node, job.format, filename, scale=scale)
+                    try:
+                        started = time.perf_counter()
+                        image.draw()
+                        drawn = time.perf_counter()
+                        save_image(image)
+                        timings['draw'] += drawn - started
+                        timings['save'] += time.perf_counter() - drawn
+                    finally:
+                        release_image(image)
+
+    timings.update(node['timings'])
+    return timings
+
+
+def render_images(jobs, workers, profiler=None, client=None, pool=None):
+    """Render *jobs* using a pool of *workers* processes.
+
+    The jobs are rendered in-process if *workers* is less than 2.  If *pool*
+    is given, it is called to get the pool (see ``map_in_pool()``).  If the
+    *client* of render server is given, the jobs are rendered by the server
+    instead; they fall back to the pool if the server goes away.
+    Returns a dict which maps the filename of each job to the exception raised
+    on rendering it (or None if succeeded).  The time spent on each job is
+    passed to the *profiler* if given.
+    """
+    jobs = list(jobs)
+    results = {}
+    rendered = []
+    if client:
+        for job in jobs:
+            try:
+                rendered.append((client.request('render', job=job), None))
+            except OSError:
+                break  # the server has gone away
+            except Exception as exc:
+                rendered.append((None, exc))
+
+    rendered.extend(map_in_pool(render_image, jobs[len(rendered):], workers, pool))
+    for job, (elapsed, exc) in zip(jobs, rendered):
+        results[job.filename] = exc
+        if exc is None and profiler is not None:
+            profiler.add(job.filename, elapsed)
+
+    return results
+
+
+def map_in_pool(func, items, workers, pool=None):
+    """Call *func* with each of *items* using a pool of *workers* processes.
+
+    The items are processed in-process if *workers* is less than 2.  They
+    are sent to the workers in batches; the workers keep fonts and diagrams
+    loaded between batches.  If *pool* is given, it is called to get the
+    pool shared between calls (see ``get_render_pool()``); otherwise, a pool
+    is started for the call.  Returns a list of pairs of the result and the
+    exception (or None) for each item.
+    """
+    if workers > 1 and len(items) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # a few batches per worker to balance the load
+        size = max(1, min(POOL_BATCH_SIZE, len(items) // (workers * 4)))
+        batches = [items[i:i + size] for i in range(0, len(items), size)]
+        results = []
+        with nullcontext(pool()) if pool else ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch in executor.map(partial(map_in_process, func), batches):
+                results.extend(batch)
+
+        return results
+    else:
+        return map_in_process(func, items)
+
+
+def get_render_pool(app):
+    """Returns the pool of render workers of the build; it is started on the first use.
+
+    The pool is shared by all doctrees and the images rendered on
+    build-finished event, and shut down on the event (see ``on_build_finished()``).
+    """
+    if app.actdiag_render_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+
+        workers = app.builder.config.actdiag_render_workers
+        app.actdiag_render_pool = ProcessPoolExecutor(max_workers=workers)
+
+    return app.actdiag_render_pool
+
+
+def map_in_process(func, items):
+    results = []
+    for item in items:
+        try:
+            results.append((func(item), None))
+        except Exception as exc:
+            results.append((None, exc))
+
+    return results
+
+
+def use_deferred_render(app):
+    """Returns True if HTML images are rendered on build-finished event."""
+    return bool(app.builder.config.actdiag_html_deferred_render or
+                getattr(app, 'actdiag_render_client', None))
+
+
+class RenderError(Exception):
+    """An error raised by the render server on rendering a diagram."""
+
+
+class RenderClient(object):
+    """A client of the render server listening on the unix socket *path*.
+
+    Each request is sent over a new connection; the client is shared by
+    threads.  Requests raise OSError if the server is not available; the
+    client is disabled after that not to wait for the server again.  The
+    modification times of font files (*fonts*; see ``get_font_stamps()``)
+    are sent with each request; the server drops the images and fonts kept
+    in memory if they are changed.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self.available = True
+        self.fonts = None
+
+    def __bool__(self):
+        return self.available
+
+    def request(self, method, **params):
+        if not self.available:
+            raise ConnectionRefusedError('render server is not available: %s' % self.path)
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                request = dict(params, method=method, fonts=self.fonts)
+                sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                with sock.makefile('rb') as stream:
+                    line = stream.readline()
+            if not line:
+                raise ConnectionResetError('render server closed the connection: %s' % self.path)
+        except OSError:
+            self.available = False
+            raise
+
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise RenderError(response['error'])
+
+        return response['result']
+
+
+def connect_render_server(path):
+    """Returns a client of the render server, or None if it is not running."""
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    client = RenderClient(path)
+    try:
+        client.request('ping')
+        return client
+    except (OSError, ValueError, RenderError) as exc:
+        logger.info('actdiag: render server is not available; rendering in-process (%s)', exc)
+        return None
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A render server keeping fonts, diagrams and images warm in memory.
+
+    It renders the jobs of the render pool (see ``render_image()``) and lays
+    out diagrams for the HTML writer (see ``actdiag_node.to_layout()``) on
+    behalf of Sphinx processes, like sphinx-autobuild runs on each change.
+    The rendered images are kept in memory up to *cachesize* bytes; they are
+    restored without drawing if removed from the output directory.  They
+    are dropped with the loaded fonts if the font files are modified (see
+    ``check_fonts()``).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, cachesize=64 * 1024 * 1024):
+        self.images = OrderedDict()
+        self.cachesize = cachesize
+        self.fonts = None
+        self.lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self, path, RenderRequestHandler)
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.server_address)
+                raise OSError('render server is already running: %s' % self.server_address)
+            except ConnectionRefusedError:
+                os.remove(self.server_address)  # stale socket
+
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+    def ping(self, fonts=None):
+        return {'version': actdiag.__version__, 'pid': os.getpid()}
+
+    def check_fonts(self, fonts):
+        """Drop the images, renderers and fonts kept in memory if *fonts* have been changed."""
+        if fonts is None:
+            return  # unknown yet
+
+        with self.lock:
+            if fonts == self.fonts:
+                return
+
+            changed = self.fonts is not None
+            self.fonts = fonts
+            self.images.clear()
+
+        if changed:
+            get_job_renderer.cache_clear()
+            clear_font_caches()
+
+    def layout(self, code, fonts=None):
+        self.check_fonts(fonts)
+        code, diagram = build_diagram(code)
+        layout = get_layout(diagram)
+        return {'code': code,
+                'pagesize': list(layout.pagesize),
+                'cells': [(href, list(box)) for href, box in layout.cells]}
+
+    def render(self, job, fonts=None):
+        self.check_fonts(fonts)
+        job = RenderJob(*job)
+        filenames = [get_scaled_path(job.filename, scale) for scale in job.scales]
+        for filename in filenames:
+            self.restore(filename)
+
+        timings = render_image(job)
+        for filename in filenames:
+            self.keep(filename)
+
+        return timings
+
+    def restore(self, filename):
+        with self.lock:
+            data = self.images.get(os.path.basename(filename))
+        if data is None or os.path.isfile(filename):
+            return
+
+        ensuredir(os.path.dirname(filename))
+        tmpname = get_temp_path(filename)
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, filename)
+
+    def keep(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        with self.lock:
+            self.images[os.path.basename(filename)] = data
+            self.images.move_to_end(os.path.basename(filename))
+            while sum(len(image) for image in self.images.values()) > self.cachesize:
+                self.images.popitem(last=False)
+
+
+class RenderRequestHandler(socketserver.StreamRequestHandler):
+    methods = ('ping', 'layout', 'render')
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            method = request.pop('method')
+            if method not in self.methods:
+                raise ValueError('unknown method: %s' % method)
+
+            response = {'result': getattr(self.server, method)(**request)}
+        except Exception as exc:
+            response = {'error': '%s' % exc}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def serve(path, cachesize):
+    """Run the render server on the unix socket *path* until interrupted (or terminated)."""
+    import signal
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    with RenderServer(path, cachesize) as server:
+        sys.stderr.write('actdiag render server is listening on %s\n' % path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+# a PNG image to be optimized (and converted to WebP) by the pool
+PostprocessJob = namedtuple('PostprocessJob', 'filename optimize quantize webp')
+
+# the key of text chunk recording the optimizations applied to PNG images
+POSTPROCESS_MARKER = 'actdiag-postprocess'
+
+
+def get_webp_path(filename):
+    return os.path.splitext(filename)[0] + '.webp'
+
+
+def postprocess_image(job):
+    """Recompress a PNG image losslessly (or quantize it), and convert it to WebP.
+
+    The applied optimizations are recorded in the image; images already
+    processed are skipped.  Returns True if the PNG image is rewritten.
+    """
+    from PIL import Image, PngImagePlugin
+
+    webp_path = get_webp_path(job.filename)
+    with Image.open(job.filename) as image:
+        applied = set(filter(None, image.info.get(POSTPROCESS_MARKER, '').split(',')))
+        requested = set(name for name in ('optimize', 'quantize') if getattr(job, name))
+        rewrite = not requested.issubset(applied)
+        convert = job.webp and (not os.path.isfile(webp_path) or
+                                os.path.getmtime(webp_path) < os.path.getmtime(job.filename))
+        if not rewrite and not convert:
+            return False
+
+        image.load()
+        if rewrite:
+            if job.quantize and image.mode != 'P':
+                image = image.quantize(colors=256, method=Image.FASTOCTREE)
+
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text(POSTPROCESS_MARKER, ','.join(sorted(applied | requested)))
+            tmpname = get_temp_path(job.filename)
+            image.save(tmpname, 'PNG', optimize=True, pnginfo=pnginfo)
+            os.replace(tmpname, job.filename)
+
+        if job.webp:
+            tmpname = get_temp_path(webp_path)
+            image.save(tmpname, 'WEBP', lossless=True, quality=100, method=6)
+            os.replace(tmpname, webp_path)
+
+    return rewrite
+
+
+def queue_postprocess_images(app, doctree):
+    """Queue PNG images of the doctree to optimize them on build-finished event."""
+    config = app.builder.config
+    if not (config.actdiag_png_optimize or config.actdiag_png_quantize or config.actdiag_html_webp):
+        return
+
+    try:
+        image_format = get_image_format_for(app.builder)
+    except Exception:
+        return  # the error will be reported on writing the page
+
+    if image_format.upper() == 'PNG':
+        scales = get_png_scales(app.builder)
+        for node in doctree.traverse(actdiag_node):
+            filename = node.get_abspath('PNG', app.builder)
+            app.actdiag_postprocess_queue.update(get_scaled_path(filename, scale) for scale in scales)
+
+
+def postprocess_images(app):
+    config = app.builder.config
+    jobs = [PostprocessJob(filename, config.actdiag_png_optimize, config.actdiag_png_quantize,
+                           config.actdiag_html_webp)
+            for filename in sorted(app.actdiag_postprocess_queue) if os.path.isfile(filename)]
+    results = map_in_pool(postprocess_image, jobs, config.actdiag_render_workers,
+                          partial(get_render_pool, app))
+    for job, (rewritten, exc) in zip(jobs, results):
+        if exc is not None:
+            logger.warning('actdiag error: could not optimize %s: %s', job.filename, exc)
+        elif rewritten:
+            store_image(app.builder, job.filename, update=True)
+
+
+def get_diagram_key(node):
+    hashseed = (node['code'] + str(node['options'])).encode('utf-8')
+    return sha1(hashseed).hexdigest()
+
+
+def get_font_stamps(renderer):
+    """Returns the modification times of font files used to render diagrams.
+
+    The fonts are not loaded; the fontmap file is just read for their paths.
+    """
+    from blockdiag.utils.fontmap import parse_fontpath
+
+    fontpath = renderer.fontpath
+    if isinstance(fontpath, str):
+        fontpath = [fontpath]
+
+    paths = list(fontpath or [])
+    if renderer.fontmappath:
+        paths.append(renderer.fontmappath)
+        paths.extend(get_fontmap_paths(renderer.fontmappath))
+
+    stamps = {}
+    for path in paths:
+        path, _ = parse_fontpath(path)
+        try:
+            stamps[path] = os.stat(path).st_mtime
+        except OSError:
+            stamps[path] = None
+
+    return stamps
+
+
+def get_fontmap_paths(fontmappath):
+    """Returns the paths of font files listed in the fontmap file."""
+    from blockdiag.utils.config import ConfigParser
+
+    config = ConfigParser()
+    try:
+        config.read(fontmappath)
+    except Exception:
+        return []  # reported on rendering (see create_fontmap())
+
+    if config.has_section('fontmap'):
+        return [path for _, path in config.items('fontmap') if path]
+    else:
+        return []
+
+
+def on_doctree_read(self, doctree):
+    # manifest of diagrams: {key: {'code': ..., 'options': ..., 'docnames': {docname: count}}}
+    if not hasattr(self.env, 'actdiag_manifest'):
+        self.env.actdiag_manifest = {}
+
+    for node in doctree.traverse(actdiag_node):
+        entry = self.env.actdiag_manifest.setdefault(get_diagram_key(node),
+                                                     dict(code=node['code'],
+                                                          options=node['options'],
+                                                          docnames={}))
+        docnames = entry['docnames']
+        docnames[self.env.docname] = docnames.get(self.env.docname, 0) + 1
+
+        # move the time of parsing and layout to the env (see DiagramProfiler)
+        if 'timings' in node:
+            self.env.actdiag_timings[(node.source, node.line)] = node.attributes.pop('timings')
+
+    if self.builder.config.actdiag_render_ahead and self.parallel <= 1:
+        queue_render_ahead(self, doctree)
+
+
+def on_env_before_read_docs(self, env, docnames):
+    env.actdiag_timings = {}
+
+
+def on_env_purge_doc(self, env, docname):
+    manifest = getattr(env, 'actdiag_manifest', {})
+    for key, entry in list(manifest.items()):
+        entry['docnames'].pop(docname, None)
+        if not entry['docnames']:
+            del manifest[key]
+
+
+def on_env_merge_info(self, env, docnames, other):
+    if not hasattr(env, 'actdiag_manifest'):
+        env.actdiag_manifest = {}
+
+    for key, entry in getattr(other, 'actdiag_manifest', {}).items():
+        if key in env.actdiag_manifest:
+            env.actdiag_manifest[key]['docnames'].update(entry['docnames'])
+        else:
+            env.actdiag_manifest[key] = entry
+
+    env.actdiag_timings.update(getattr(other, 'actdiag_timings', {}))
+
+
+def on_env_get_outdated(self, env, added, changed, removed):
+    """Re-render diagrams if the font files have been modified."""
+    stamps = get_font_stamps(self.actdiag_renderer)
+    if self.actdiag_render_client:
+        self.actdiag_render_client.fonts = stamps
+
+    if stamps == getattr(env, 'actdiag_font_stamps', stamps):
+        env.actdiag_font_stamps = stamps
+        return []
+
+    env.actdiag_font_stamps = stamps
+    self.actdiag_svg_cache.clear()
+
+    docnames = set()
+    for entry in getattr(env, 'actdiag_manifest', {}).values():
+        docnames.update(entry['docnames'])
+        for filename in get_manifest_images(self.builder, entry):
+            for path in (filename, get_cache_path(self, filename)):
+                if path and os.path.isfile(path):
+                    os.remove(path)
+
+    return sorted(docnames - set(removed))
+
+
+def get_manifest_images(builder, entry):
+    """Returns the filenames of images for the diagram in the manifest."""
+    try:
+        image_format = get_image_format_for(builder)
+    except Exception:
+        return []
+
+    if (builder.format in ('html', 'slides') and image_format.upper() == 'SVG' and
+            builder.config.actdiag_html_svg_mode != 'external'):
+        return []  # embedded into HTML
+
+    node = actdiag_node(code=entry['code'], options=entry['options'])
+    filename = node.get_abspath(image_format, builder)
+    if image_format.upper() != 'PNG':
+        return [filename]
+
+    filenames = [get_scaled_path(filename, scale) for scale in get_png_scales(builder)]
+    if builder.format in ('html', 'slides') and builder.config.actdiag_html_webp:
+        filenames.extend([get_webp_path(path) for path in filenames])
+
+    return filenames
+
+
+def collect_garbage_images(app):
+    """Remove images no longer used by any documents."""
+    node = actdiag_node(code='', options={})
+    imagedir = os.path.dirname(node.get_abspath('PNG', app.builder))
+
+    used = set()
+    for entry in getattr(app.env, 'actdiag_manifest', {}).values():
+        for filename in get_manifest_images(app.builder, entry):
+            used.add(IMAGE_FILENAME.match(os.path.basename(filename)).group(1))
+
+    for filename in os.listdir(imagedir):
+        matched = IMAGE_FILENAME.match(filename)
+        if matched and matched.group(1) not in used:
+            try:
+                os.remove(os.path.join(imagedir, filename))
+            except OSError:
+                pass
+
+
+def report_image_sizes(app, top):
+    """Log the total size of images, and the *top* largest ones with their documents."""
+    sizes = []
+    for entry in getattr(app.env, 'actdiag_manifest', {}).values():
+        for filename in get_manifest_images(app.builder, entry):
+            try:
+                sizes.append((os.path.getsize(filename), os.path.basename(filename),
+                              sorted(entry['docnames'])))
+            except OSError:
+                pass  # not rendered
+
+    sizes.sort(key=lambda size: (-size[0], size[1]))
+    logger.info('actdiag images: %d files, %.1f KB in total; top %d:',
+                len(sizes), sum(size[0] for size in sizes) / 1024.0, min(top, len(sizes)))
+    for size, basename, docnames in sizes[:top]:
+        logger.info('  %8.1f KB %s (%s)', size / 1024.0, basename, ', '.join(docnames))
+
 
 def on_doctree_resolved(self, doctree, docname):
     if self.builder.format in ('html', 'slides'):
+        if self.actdiag_cache is not None:
+            prefetch_images(self, doctree)
+        if use_deferred_render(self):
+            queue_deferred_images(self, doctree)
+        queue_postprocess_images(self, doctree)
+        return
+    elif not any(doctree.traverse(actdiag_node)):
         return
 
     try:
@@ -288,14 +2203,20 @@ def on_doctree_resolved(self, doctree, docname):
 
         return
 
+    if self.builder.config.actdiag_render_workers > 1 or self.actdiag_render_client:
+        render_doctree_in_parallel(self.builder, doctree, image_format)
+        return
+
     for node in doctree.traverse(actdiag_node):
+        if self.actdiag_profiler:
+            self.actdiag_profiler.get_record(node, image_format)
+
         try:
-            with Application():
+            with blockdiag_context:
                 relfn = node.get_relpath(image_format, self.builder)
-                image = node.to_drawer(image_format, self.builder)
-                if not os.path.isfile(image.filename):
-                    image.draw()
-                    image.save()
+                filename = node.get_abspath(image_format, self.builder)
+                create_image = partial(node.to_drawer, image_format, self.builder, filename=filename)
+                render_on_demand(self.builder, filename, create_image, node)
 
                 image = nodes.image(uri=relfn, candidates={'*': relfn}, **node['options'])
                 node.parent.replace(node, image)
@@ -307,6 +2228,222 @@ def on_doctree_resolved(self, doctree, docname):
             node.parent.remove(node)
 
 
+def render_doctree_in_parallel(builder, doctree, image_format):
+    config = builder.config
+    profiler = builder.app.actdiag_profiler
+    targets = []
+    jobs = {}
+    for node in doctree.traverse(actdiag_node):
+        if profiler:
+            profiler.get_record(node, image_format)
+
+        relfn = node.get_relpath(image_format, builder)
+        job = node.to_render_job(image_format, builder)
+        targets.append((node, relfn, job.filename))
+
+        if job.filename not in jobs and not find_image(builder, job.filename):
+            jobs[job.filename] = job
+            if profiler:
+                profiler.assign(job.filename, node, image_format)
+
+    errors = render_images(jobs.values(), config.actdiag_render_workers, profiler,
+                           builder.app.actdiag_render_client, partial(get_render_pool, builder.app))
+    for filename, exc in errors.items():
+        if exc is None:
+            store_image(builder, filename)
+
+    # rewrite doctree in document order
+    for node, relfn, filename in targets:
+        exc = errors.get(filename)
+        if exc is None:
+            image = nodes.image(uri=relfn, candidates={'*': relfn}, **node['options'])
+            node.parent.replace(node, image)
+        else:
+            if config.actdiag_debug:
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+            logger.warning('dot code %r: %s', node['code'], exc)
+            node.parent.remove(node)
+
+
+def prefetch_images(app, doctree):
+    """Place the cached images of the doctree into the output directory.
+
+    The doctree-resolved event is always emitted on the main process; the
+    hits and misses of the cache are counted here even if the HTML pages are
+    written in parallel (the counts in the writer processes are lost).
+    """
+    try:
+        image_format = get_image_format_for(app.builder)
+    except Exception:
+        return  # the error will be reported on writing the page
+
+    if image_format.upper() == 'SVG' and app.builder.config.actdiag_html_svg_mode != 'external':
+        return  # embedded into HTML
+
+    scales = get_png_scales(app.builder) if image_format.upper() == 'PNG' else [1]
+    for node in doctree.traverse(actdiag_node):
+        if image_format.upper() == 'SVG' and ':ref:' in node['code']:
+            continue  # rendered in each build (see html_render_svg_external())
+
+        filename = node.get_abspath(image_format, app.builder)
+        for scale in scales:
+            find_image(app.builder, get_scaled_path(filename, scale))
+
+
+def queue_deferred_images(app, doctree):
+    """Queue PNG images of the doctree to render them on build-finished event.
+
+    The doctree-resolved event is always emitted on the main process, even if
+    the HTML pages are written in parallel.
+    """
+    try:
+        image_format = get_image_format_for(app.builder)
+    except Exception:
+        return  # the error will be reported on writing the page
+
+    if image_format.upper() != 'PNG':
+        return
+
+    scales = get_png_scales(app.builder)
+    for node in doctree.traverse(actdiag_node):
+        job = node.to_render_job('PNG', app.builder, scales)
+        filenames = [get_scaled_path(job.filename, scale) for scale in scales]
+        if (job.filename not in app.actdiag_render_queue and
+                not all([find_image(app.builder, filename) for filename in filenames])):
+            app.actdiag_render_queue[job.filename] = job
+            if app.actdiag_profiler:
+                app.actdiag_profiler.assign(job.filename, node, 'PNG')
+
+
+def queue_render_ahead(app, doctree):
+    """Start rendering the images of the doctree in background threads.
+
+    The images are rendered while the other documents are read (and written);
+    the writers find them rendered, or wait for them by the locks of images
+    (see ``render_on_demand()``).  The images rendered on build-finished event
+    or by the render pool are not rendered ahead.  The threads are shut down
+    on build-finished event, and the errors are reported there.
+    """
+    config = app.builder.config
+    if app.builder.format in ('html', 'slides'):
+        if use_deferred_render(app):
+            return
+    elif config.actdiag_render_workers > 1 or app.actdiag_render_client:
+        return
+
+    try:
+        image_format = get_image_format_for(app.builder)
+    except Exception:
+        return  # the error will be reported on writing
+
+    if image_format.upper() == 'SVG':
+        return  # SVG images are written by the writers
+
+    scales = get_png_scales(app.builder) if image_format.upper() == 'PNG' else [1]
+    for node in doctree.traverse(actdiag_node):
+        # the node is not modified; the doctree might be pickled at the same time
+        job = node.to_render_job(image_format, app.builder, scales)
+        filenames = [get_scaled_path(job.filename, scale) for scale in scales]
+        if (job.filename not in app.actdiag_render_ahead_futures and
+                not all([find_image(app.builder, filename) for filename in filenames])):
+            if app.actdiag_render_ahead is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                app.actdiag_render_ahead = ThreadPoolExecutor(int(config.actdiag_render_ahead),
+                                                              thread_name_prefix='actdiag')
+            future = app.actdiag_render_ahead.submit(render_ahead, app.builder, job)
+            app.actdiag_render_ahead_futures[job.filename] = future
+
+
+def render_ahead(builder, job):
+    render_image(job)
+    for scale in job.scales:
+        store_image(builder, get_scaled_path(job.filename, scale))
+
+
+def on_build_finished(self, exception):
+    # wait for the images rendered ahead; they might not be written by the writers
+    executor = getattr(self, 'actdiag_render_ahead', None)
+    if executor is not None:
+        executor.shutdown(wait=True)
+        self.actdiag_render_ahead = None
+
+    for filename, future in getattr(self, 'actdiag_render_ahead_futures', {}).items():
+        exc = future.exception()
+        if exc is not None:
+            if self.builder.config.actdiag_debug:
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+            logger.warning('actdiag error: could not render %s ahead: %s', os.path.basename(filename), exc)
+    self.actdiag_render_ahead_futures = {}
+
+    # labels might be changed until the next build
+    self.actdiag_labels = {}
+    self.actdiag_undefined_labels = set()
+
+    jobs = getattr(self, 'actdiag_render_queue', {})
+    if exception is None and jobs:
+        errors = render_images(jobs.values(), self.builder.config.actdiag_render_workers,
+                               self.actdiag_profiler, self.actdiag_render_client,
+                               partial(get_render_pool, self))
+        for job in jobs.values():
+            exc = errors.get(job.filename)
+            if exc is None:
+                for scale in job.scales:
+                    store_image(self.builder, get_scaled_path(job.filename, scale))
+            else:
+                if self.builder.config.actdiag_debug:
+                    traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+                logger.warning('dot code %r: %s', job.code, exc)
+
+    self.actdiag_render_queue = {}
+
+    if exception is None and self.actdiag_postprocess_queue:
+        postprocess_images(self)
+    self.actdiag_postprocess_queue = set()
+
+    pool = getattr(self, 'actdiag_render_pool', None)
+    if pool is not None:
+        pool.shutdown(wait=True)
+        self.actdiag_render_pool = None
+
+    # nothing is drawn until the next build; do not affect the other extensions
+    uninstall_font_caches()
+
+    if exception is None and self.builder.config.actdiag_svg_cache_persist:
+        save_svg_cache(self)
+
+    if exception is None and self.builder.config.actdiag_gc_images:
+        collect_garbage_images(self)
+
+    if exception is None and self.builder.config.actdiag_size_report:
+        report_image_sizes(self, int(self.builder.config.actdiag_size_report))
+
+    manifest = getattr(self.env, 'actdiag_manifest', {})
+    if exception is None and manifest:
+        occurrences = sum(sum(entry['docnames'].values()) for entry in manifest.values())
+        logger.info('actdiag: %d diagrams, %d unique (dedup ratio: %.1f%%)',
+                    occurrences, len(manifest), 100.0 * (occurrences - len(manifest)) / occurrences)
+
+    cache = getattr(self, 'actdiag_cache', None)
+    if cache is not None:
+        logger.info('actdiag cache: %d hits, %d misses', cache.hits, cache.misses)
+        cache.reset_counters()
+        cache.evict()
+
+    profiler = getattr(self, 'actdiag_profiler', None)
+    if profiler is not None:
+        if profiler.profile:
+            profiler.profile.disable()
+            profiler.profile.dump_stats(get_profile_output(self, 'prof'))
+        if exception is None:
+            profiler.report(self.builder.config.actdiag_profile_top)
+            if get_profile_output(self, 'json'):
+                profiler.dump(get_profile_output(self, 'json'))
+
+
 def setup(app):
     app.add_node(actdiag_node,
                  html=(html_visit_actdiag, html_depart_actdiag))
@@ -317,13 +2454,266 @@ def setup(app):
     app.add_config_value('actdiag_transparency', True, 'html')
     app.add_config_value('actdiag_debug', False, 'html')
     app.add_config_value('actdiag_html_image_format', 'PNG', 'html')
+    app.add_config_value('actdiag_html_svg_mode', 'inline', 'html')  # inline or external
     app.add_config_value('actdiag_tex_image_format', None, 'html')  # backward compatibility for 0.6.1
     app.add_config_value('actdiag_latex_image_format', 'PNG', 'html')
+    app.add_config_value('actdiag_render_workers', 0, 'html')
+    app.add_config_value('actdiag_html_deferred_render', False, 'html')
+    app.add_config_value('actdiag_render_ahead', 0, '')  # number of threads
+    app.add_config_value('actdiag_cache_dir', None, 'html')
+    app.add_config_value('actdiag_cache_size', None, 'html')  # in bytes
+    app.add_config_value('actdiag_svg_cache_persist', False, 'html')
+    app.add_config_value('actdiag_gc_images', True, 'html')
+    app.add_config_value('actdiag_png_optimize', False, 'html')
+    app.add_config_value('actdiag_png_quantize', False, 'html')
+    app.add_config_value('actdiag_html_webp', False, 'html')
+    app.add_config_value('actdiag_png_scales', [1], 'html')  # ex. [1, 2] for HiDPI displays
+    app.add_config_value('actdiag_max_canvas_pixels', None, 'html')  # ex. 50000000
+    app.add_config_value('actdiag_svg_minify', False, 'html')
+    app.add_config_value('actdiag_svg_precision', None, 'html')  # decimal places of coordinates
+    app.add_config_value('actdiag_render_server', None, '')  # path to unix socket
+    app.add_config_value('actdiag_size_report', 0, '')  # number of the largest images to list
+    app.add_config_value('actdiag_profile', False, '')
+    app.add_config_value('actdiag_profile_top', 10, '')
+    app.add_config_value('actdiag_profile_output', None, '')  # *.json or cProfile stats
+    app.connect("config-inited", on_config_inited)
     app.connect("builder-inited", on_builder_inited)
+    app.connect("env-before-read-docs", on_env_before_read_docs)
+    app.connect("doctree-read", on_doctree_read)
+    app.connect("env-purge-doc", on_env_purge_doc)
+    app.connect("env-merge-info", on_env_merge_info)
+    app.connect("env-get-outdated", on_env_get_outdated)
     app.connect("doctree-resolved", on_doctree_resolved)
+    app.connect("build-finished", on_build_finished)
 
     return {
-        'version': pkg_resources.require('actdiag')[0].version,
+        'version': actdiag.__version__,
         'parallel_read_safe': True,
         'parallel_write_safe': True,
     }
+
+
+# actdiag directives in reST sources (see scan_directives())
+DIRECTIVE = re.compile(r'^(\s*)\.\. actdiag::(.*)$')
+
+
+class PrerenderApp(object):
+    """A stand-in of Sphinx application for ``prerender()``.
+
+    It loads the configuration values of this extension via ``setup()``,
+    and holds the state referred by the render functions.
+    """
+
+    def __init__(self, config, doctreedir):
+        self.config = config
+        self.doctreedir = doctreedir  # for locks of images (see get_lock_dir())
+        self.actdiag_cache = None
+
+    def add_config_value(self, name, default, rebuild):
+        self.config.add(name, default, rebuild, ())
+
+    def add_node(self, *args, **kwargs):
+        pass  # not needed to read configuration
+
+    add_directive = connect = add_node
+
+
+def scan_directives(text):
+    """Yields the line numbers and the sources of actdiag directives in reST *text*.
+
+    The sources are dedented; a directive ends at the first non-blank line
+    indented no more than itself.
+    """
+    lines = text.splitlines()
+    for lineno, line in enumerate(lines):
+        matched = DIRECTIVE.match(line)
+        if matched:
+            indent = len(matched.group(1))
+            block = [line[indent:]]
+            for following in lines[lineno + 1:]:
+                if following.strip() and len(following) - len(following.lstrip()) <= indent:
+                    break
+                block.append(following[indent:])
+
+            yield lineno + 1, '\n'.join(block)
+
+
+def find_diagrams(srcdir, filename):
+    """Returns the actdiag nodes in the reST file; they are the same as the directive generates.
+
+    Invalid directives are ignored; they are reported by Sphinx later.
+    """
+    from docutils.core import publish_doctree
+
+    with open(filename, encoding='utf-8-sig') as f:
+        text = f.read()
+
+    diagrams = []
+    for lineno, source in scan_directives(text):
+        matched = DIRECTIVE.match(source.splitlines()[0])
+        argument = matched.group(2).strip()
+        if argument:
+            # refer the external file by absolute path (see BlockdiagDirective.source_filename())
+            if argument.startswith('/'):
+                path = os.path.join(srcdir, argument[1:])
+            else:
+                path = os.path.join(os.path.dirname(filename), argument)
+            source = '.. actdiag:: %s%s' % (os.path.abspath(path), source[matched.end():])
+
+        settings = {'report_level': 5, 'halt_level': 5, 'file_insertion_enabled': False}
+        doctree = publish_doctree(source, source_path='%s:%d' % (filename, lineno),
+                                  settings_overrides=settings)
+        diagrams.extend(doctree.traverse(actdiag_node))
+
+    return diagrams
+
+
+def prerender(srcdir, buildername='html', outdir=None, confdir=None, overrides=None, workers=None,
+              tags=None):
+    """Render the images of actdiag directives in the source directory before building it.
+
+    The images are written to the image directory of *outdir* if given, or
+    to ``actdiag_cache_dir`` otherwise; the builder finds them by the same
+    filenames (see ``get_path()``).  The sources are scanned without Sphinx;
+    diagrams in files included by other directives are not found, and
+    diagrams having ``:ref:`` are rendered only as PNG (their links are
+    resolved by the builder).  *tags* are the tags given to conf.py (like
+    ``sphinx-build -t``).  Returns the number of failed diagrams.
+    """
+    from types import SimpleNamespace
+    from docutils.parsers.rst.directives import register_directive
+    from sphinx.config import Config, convert_source_suffix
+    from sphinx.errors import ConfigError
+    from sphinx.project import Project
+    from sphinx.util.docutils import docutils_namespace
+    from sphinx.util.tags import Tags
+
+    srcdir = os.path.abspath(srcdir)
+    confdir = os.path.abspath(confdir or srcdir)
+    if not os.path.isfile(os.path.join(confdir, 'conf.py')):
+        raise ConfigError("config directory doesn't contain a conf.py file (%s)" % confdir)
+    config = Config.read(confdir, overrides, Tags(tags))
+    lockdir = tempfile.mkdtemp()
+    app = PrerenderApp(config, lockdir)
+    setup(app)
+    config.init_values()
+    convert_source_suffix(None, config)
+
+    if buildername not in ('html', 'latex'):
+        raise ValueError('unknown builder: %s' % buildername)
+    builder = SimpleNamespace(app=app, config=config, format=buildername)
+    image_format = get_image_format_for(builder)
+    if image_format == 'SVG':
+        # SVG images are written by the builder itself (see html_render_svg())
+        sys.stderr.write('actdiag: nothing to prerender; SVG images are generated on build\n')
+        return 0
+
+    if outdir:
+        builder.outdir = os.path.abspath(outdir)
+        builder.imagedir = '_images' if buildername == 'html' else ''
+        if config.actdiag_cache_dir:
+            app.actdiag_cache = ImageCache(os.path.join(confdir, config.actdiag_cache_dir),
+                                           config.actdiag_cache_size)
+    elif config.actdiag_cache_dir:
+        builder.outdir = os.path.join(confdir, config.actdiag_cache_dir)
+        builder.imagedir = ''
+    else:
+        raise ValueError('no place to save images; give the output directory, or set actdiag_cache_dir')
+
+    suffixes = OrderedDict((suffix, filetype) for suffix, filetype in config.source_suffix.items()
+                           if filetype in (None, 'restructuredtext'))
+    project = Project(srcdir, suffixes)
+    docnames = project.discover(config.exclude_patterns + config.templates_path)
+
+    started = time.perf_counter()
+    scales = get_png_scales(builder) if image_format == 'PNG' else [1]
+    jobs = OrderedDict()
+    count = 0
+    try:
+        # the directive is registered to docutils only while scanning
+        with docutils_namespace():
+            register_directive('actdiag', Actdiag)
+            for docname in sorted(docnames):
+                for node in find_diagrams(srcdir, project.doc2path(docname)):
+                    count += 1
+                    if ':ref:' in node['code'] and image_format != 'PNG':
+                        continue
+
+                    job = node.to_render_job(image_format, builder, scales)
+                    filenames = [get_scaled_path(job.filename, scale) for scale in scales]
+                    if job.filename not in jobs and not all([find_image(builder, f) for f in filenames]):
+                        jobs[job.filename] = job
+
+        scanned = time.perf_counter()
+        errors = render_images(jobs.values(), os.cpu_count() if workers is None else workers)
+    finally:
+        shutil.rmtree(lockdir, ignore_errors=True)
+
+    failures = 0
+    for job in jobs.values():
+        exc = errors.get(job.filename)
+        if exc is None:
+            for scale in scales:
+                store_image(builder, get_scaled_path(job.filename, scale))
+        else:
+            failures += 1
+            sys.stderr.write('actdiag: dot code %r: %s\n' % (job.code, exc))
+
+    elapsed = time.perf_counter() - scanned
+    # the report is written to stderr like the errors; stdout is left for data
+    sys.stderr.write('actdiag: %d diagrams in %d documents, scanned in %.2fs\n' %
+                     (count, len(docnames), scanned - started))
+    sys.stderr.write('actdiag: rendered %d images in %.2fs (%.1f images/s), %d failed\n' %
+                     (len(jobs) - failures, elapsed, (len(jobs) - failures) / elapsed if elapsed else 0,
+                      failures))
+    return failures
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m sphinxcontrib.actdiag')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    server = subparsers.add_parser('serve', help='run a render server on the unix socket')
+    server.add_argument('socket', help='path to the unix socket (set it to actdiag_render_server)')
+    server.add_argument('--cache-size', type=int, default=64 * 1024 * 1024,
+                        help='bytes of rendered images kept in memory (default: 64MB)')
+
+    prerenderer = subparsers.add_parser('prerender', help='render images of the source directory in advance')
+    prerenderer.add_argument('srcdir', help='source directory of Sphinx')
+    prerenderer.add_argument('outdir', nargs='?',
+                             help='output directory of Sphinx (default: actdiag_cache_dir)')
+    prerenderer.add_argument('-b', dest='builder', default='html', choices=('html', 'latex'),
+                             help='builder to render images for (default: html)')
+    prerenderer.add_argument('-c', dest='confdir', help='directory containing conf.py (default: srcdir)')
+    prerenderer.add_argument('-D', dest='define', action='append', default=[], metavar='setting=value',
+                             help='override a setting in conf.py')
+    prerenderer.add_argument('-j', dest='workers', type=int,
+                             help='number of worker processes (default: number of CPUs)')
+    prerenderer.add_argument('-t', dest='tags', action='append', default=[], metavar='tag',
+                             help='define tag: include "only" blocks with tag (given to conf.py)')
+
+    options = parser.parse_args(argv)
+    if options.command == 'serve':
+        serve(options.socket, options.cache_size)
+    elif options.command == 'prerender':
+        from sphinx.errors import ConfigError
+
+        if any('=' not in define for define in options.define):
+            prerenderer.error('-D expects name=value')
+
+        try:
+            overrides = dict(define.split('=', 1) for define in options.define)
+            failures = prerender(options.srcdir, options.builder, options.outdir, options.confdir,
+                                 overrides, options.workers, options.tags)
+        except (ConfigError, ValueError) as exc:
+            sys.stderr.write('actdiag: error: %s\n' % exc)
+            sys.exit(2)
+
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import subprocess
+import sys
+
 from sphinx_testing import with_app
 
 
@@ -26,3 +29,13 @@ def test_build_epub(app, status, warning):
 @with_app(buildername='json', srcdir='tests/docs/basic/')
 def test_build_json(app, status, warning):
     app.builder.build_all()
+
+
+def test_import_without_renderer():
+    # actdiag's parser and drawers are loaded on demand
+    script = ('import sys\n'
+              'import sphinxcontrib.actdiag\n'
+              'heavy = ("actdiag.parser", "actdiag.drawer", "funcparserlib", "blockdiag.utils.bootstrap")\n'
+              'print(",".join(name for name in heavy if name in sys.modules))\n')
+    output = subprocess.check_output([sys.executable, '-c', script])
+    assert output.strip() == b''
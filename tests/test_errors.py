@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import sphinxcontrib.actdiag
 from mock import patch
+from sphinx.errors import ConfigError
 from sphinx_testing import with_app
 
+import io
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 
@@ -23,6 +29,16 @@ class TestSphinxcontribActdiagErrors(unittest.TestCase):
         app.builder.build_all()
         self.assertIn('unknown format: JPG', warning.getvalue())
 
+    @with_app(srcdir='tests/docs/basic')
+    def test_invalid_png_scales_error(self, app, status, warning):
+        app.config.actdiag_png_scales = [1, 1.5]
+        with self.assertRaisesRegex(ConfigError, "actdiag_png_scales must be positive integers: 1.5"):
+            app.emit('config-inited', app.config)
+
+        app.config.actdiag_png_scales = ['2x']
+        with self.assertRaisesRegex(ConfigError, "actdiag_png_scales must be positive integers: '2x'"):
+            app.emit('config-inited', app.config)
+
     @with_app(srcdir='tests/docs/basic', confoverrides=dict(actdiag_html_image_format='PDF'))
     def test_reportlab_not_found_error(self, app, status, warning):
         try:
@@ -45,9 +61,77 @@ class TestSphinxcontribActdiagErrors(unittest.TestCase):
         self.assertIn('UNKNOWN ERROR!', warning.getvalue())
 
     @with_app(srcdir='tests/docs/basic')
-    @patch("sphinxcontrib.actdiag.actdiag.drawer.DiagramDraw.draw")
+    @patch("actdiag.drawer.DiagramDraw.draw")
     def test_font_settings_error(self, app, status, warning, draw):
         draw.side_effect = UnicodeEncodeError("", "", 0, 0, "")
         app.builder.build_all()
         self.assertIn('UnicodeEncodeError caught (check your font settings)',
                       warning.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', write_docstring=True)
+    def test_incomplete_image_is_not_left(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        def save(self, size=None):
+            with open(self.filename, 'wb') as f:
+                f.write(b'incomplete')
+            raise IOError('disk full')
+
+        (app.outdir / '_images').rmtree(ignore_errors=True)
+        with patch("actdiag.drawer.DiagramDraw.save", save):
+            app.build(force_all=True)
+        self.assertIn('disk full', warning.getvalue())
+        self.assertEqual([], os.listdir(app.outdir / '_images'))
+
+        # the image is rendered on next build
+        app.build(force_all=True)
+        images = os.listdir(app.outdir / '_images')
+        self.assertEqual(1, len(images))
+        with open(app.outdir / '_images' / images[0], 'rb') as f:
+            self.assertEqual(b'\x89PNG', f.read(4))
+
+    def test_prerender_errors(self):
+        srcdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(srcdir, 'conf.py'), 'w') as f:
+                f.write("actdiag_cache_dir = '_cache'\n"
+                        "if tags.has('hidpi'):\n"
+                        "    actdiag_png_scales = [1, 2]\n")
+            with open(os.path.join(srcdir, 'index.rst'), 'w') as f:
+                f.write('.. actdiag::\n\n   A -> B;\n')
+
+            # the report is written to stderr; nothing to stdout
+            with patch('sys.stdout', new_callable=io.StringIO) as stdout, \
+                    patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                with self.assertRaises(SystemExit) as cm:
+                    sphinxcontrib.actdiag.main(['prerender', srcdir, '-j', '0', '-t', 'hidpi'])
+            self.assertEqual(0, cm.exception.code)
+            self.assertEqual(2, len(os.listdir(os.path.join(srcdir, '_cache'))))
+            self.assertEqual('', stdout.getvalue())
+            self.assertIn('actdiag: rendered 1 images in', stderr.getvalue())
+
+            # malformed -D options are reported by argparse
+            with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                with self.assertRaises(SystemExit) as cm:
+                    sphinxcontrib.actdiag.main(['prerender', srcdir, '-D', 'actdiag_png_scales'])
+            self.assertEqual(2, cm.exception.code)
+            self.assertIn('error: -D expects name=value', stderr.getvalue())
+
+            # configuration errors are reported without traceback
+            with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                with self.assertRaises(SystemExit) as cm:
+                    sphinxcontrib.actdiag.main(['prerender', srcdir, '-D', 'actdiag_png_scales=1,1.5'])
+            self.assertEqual(2, cm.exception.code)
+            self.assertEqual("actdiag: error: actdiag_png_scales must be positive integers: '1.5'\n",
+                             stderr.getvalue())
+
+            with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                with self.assertRaises(SystemExit) as cm:
+                    sphinxcontrib.actdiag.main(['prerender', srcdir, '-c', os.path.join(srcdir, '_cache')])
+            self.assertEqual(2, cm.exception.code)
+            self.assertIn("doesn't contain a conf.py file", stderr.getvalue())
+        finally:
+            shutil.rmtree(srcdir)
@@ -1,8 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import actdiag.drawer
+import actdiag.parser
+import sphinxcontrib.actdiag
+from mock import patch
+from PIL import Image, ImageFont
 from sphinx_testing import with_app
 
+import io
+import os
+import json
+import pickle
+import re
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 with_png_app = with_app(srcdir='tests/docs/basic',
                         buildername='html',
@@ -13,6 +26,96 @@ with_svg_app = with_app(srcdir='tests/docs/basic',
                         confoverrides={
                             'actdiag_html_image_format': 'SVG',
                         })
+with_canvas_limit_app = with_app(srcdir='tests/docs/basic',
+                                 buildername='html',
+                                 write_docstring=True,
+                                 confoverrides={
+                                     'actdiag_antialias': True,
+                                     'actdiag_png_scales': [1, 2],
+                                     'actdiag_max_canvas_pixels': 200000,
+                                 })
+with_render_ahead_app = with_app(srcdir='tests/docs/basic',
+                                 buildername='html',
+                                 write_docstring=True,
+                                 confoverrides={
+                                     'actdiag_render_ahead': 2,
+                                     'actdiag_png_scales': [1, 2],
+                                 })
+with_fontmap_app = with_app(srcdir='tests/docs/basic',
+                            buildername='html',
+                            write_docstring=True,
+                            confoverrides={
+                                'actdiag_fontmap': os.path.join(os.path.dirname(__file__), 'docs', 'fontmap.ini'),
+                            })
+with_deferred_app = with_app(srcdir='tests/docs/basic',
+                             buildername='html',
+                             write_docstring=True,
+                             confoverrides={
+                                 'actdiag_html_deferred_render': True,
+                                 'actdiag_render_workers': 2,
+                             })
+with_cached_app = with_app(srcdir='tests/docs/basic',
+                           buildername='html',
+                           write_docstring=True,
+                           confoverrides={
+                               'actdiag_cache_dir': tempfile.mkdtemp(),
+                           })
+with_svg_cached_app = with_app(srcdir='tests/docs/basic',
+                               buildername='html',
+                               write_docstring=True,
+                               confoverrides={
+                                   'actdiag_html_image_format': 'SVG',
+                                   'actdiag_svg_cache_persist': True,
+                               })
+actdiag_fontpath = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+with_font_app = with_app(srcdir='tests/docs/basic',
+                         buildername='html',
+                         write_docstring=True,
+                         confoverrides={
+                             'actdiag_fontpath': actdiag_fontpath,
+                         })
+with_svg_minified_app = with_app(srcdir='tests/docs/basic',
+                                 buildername='html',
+                                 write_docstring=True,
+                                 confoverrides={
+                                     'actdiag_html_image_format': 'SVG',
+                                     'actdiag_svg_minify': True,
+                                     'actdiag_svg_precision': 1,
+                                 })
+with_svg_external_app = with_app(srcdir='tests/docs/basic',
+                                 buildername='html',
+                                 write_docstring=True,
+                                 confoverrides={
+                                     'actdiag_html_image_format': 'SVG',
+                                     'actdiag_html_svg_mode': 'external',
+                                 })
+with_optimized_app = with_app(srcdir='tests/docs/basic',
+                              buildername='html',
+                              write_docstring=True,
+                              confoverrides={
+                                  'actdiag_png_optimize': True,
+                                  'actdiag_png_quantize': True,
+                                  'actdiag_html_webp': True,
+                              })
+with_hidpi_app = with_app(srcdir='tests/docs/basic',
+                          buildername='html',
+                          write_docstring=True,
+                          confoverrides={
+                              'actdiag_png_scales': [1, 2],
+                          })
+with_render_server_app = with_app(srcdir='tests/docs/basic',
+                                  buildername='html',
+                                  write_docstring=True,
+                                  confoverrides={
+                                      'actdiag_render_server': os.path.join(tempfile.mkdtemp(), 'actdiag.sock'),
+                                  })
+with_profile_app = with_app(srcdir='tests/docs/basic',
+                            buildername='html',
+                            write_docstring=True,
+                            confoverrides={
+                                'actdiag_profile': True,
+                                'actdiag_profile_output': 'actdiag_profile.json',
+                            })
 
 
 class TestSphinxcontribActdiagHTML(unittest.TestCase):
@@ -179,11 +282,90 @@ class TestSphinxcontribActdiagHTML(unittest.TestCase):
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, (r'<div class="align-default">'
                                           r'<a class="reference internal image-reference" href="(.*?.png)">'
-                                          r'<map name="(map_\d+)">'
+                                          r'<map name="(map_[0-9a-f]{40})">'
                                           r'<area shape="rect" coords="32.0,60.0,96.0,80.0" '
                                           r'href="http://blockdiag.com/"></map>'
                                           r'<img .*? src="\1" usemap="#\2" .*?/></a></div>'))
 
+    @with_png_app
+    @patch("actdiag.parser.parse_string", wraps=actdiag.parser.parse_string)
+    def test_parse_diagram_once(self, app, status, warning, parse_string):
+        """
+        .. actdiag::
+
+           parse_once_A -> parse_once_B;
+
+        .. actdiag::
+
+           parse_once_A -> parse_once_B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(2, len(re.findall('<img', source)))
+        self.assertEqual(2, parse_string.call_count)  # parse without and with "actdiag { }"
+
+    @unittest.skipUnless(os.path.exists(actdiag_fontpath), "TrueType font not found")
+    @with_font_app
+    @patch("PIL.ImageFont.truetype", wraps=ImageFont.truetype)
+    def test_font_cache(self, app, status, warning, truetype):
+        """
+        .. actdiag::
+
+           font_cache_A -> font_cache_B;
+
+        .. actdiag::
+
+           font_cache_C -> font_cache_D;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(2, len(re.findall('<img', source)))
+        self.assertLessEqual(truetype.call_count, 1)  # the font is loaded only once
+
+    @with_png_app
+    def test_font_cache_is_uninstalled(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        from blockdiag.imagedraw import png, svg
+
+        def get_font_functions():
+            return (png.ttfont_for, png.ImageDrawExBase.__dict__['textlinesize'],
+                    svg.SVGImageDrawElement.__dict__['textlinesize'])
+
+        sphinxcontrib.actdiag.uninstall_font_caches()
+        originals = get_font_functions()
+        with patch.object(sphinxcontrib.actdiag, 'install_font_cache',
+                          wraps=sphinxcontrib.actdiag.install_font_cache) as install_font_cache:
+            app.build(force_all=True)
+        self.assertTrue(install_font_cache.called)
+
+        # the functions of blockdiag are restored for the other extensions
+        self.assertEqual(originals, get_font_functions())
+        self.assertEqual({}, sphinxcontrib.actdiag.font_cache_originals)
+
+    @with_png_app
+    @patch("sphinxcontrib.actdiag.create_fontmap")
+    def test_fontmap_is_not_loaded_without_diagrams(self, app, status, warning, create_fontmap):
+        """
+        hello world
+        """
+        app.builder.build_all()
+        self.assertFalse(create_fontmap.called)
+
+    @with_fontmap_app
+    @patch("sphinxcontrib.actdiag.create_fontmap")
+    def test_fontmap_is_not_loaded_for_font_stamps(self, app, status, warning, create_fontmap):
+        """
+        hello world
+        """
+        app.builder.build_all()
+        self.assertFalse(create_fontmap.called)
+        self.assertEqual(set([app.config.actdiag_fontmap, '/path/to/font.ttf']),
+                         set(app.env.actdiag_font_stamps))
+
     @with_png_app
     def test_reftarget_in_href_on_png1(self, app, status, warning):
         """
@@ -199,7 +381,7 @@ class TestSphinxcontribActdiagHTML(unittest.TestCase):
         """
         app.builder.build_all()
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
-        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_\d+)">'
+        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_[0-9a-f]{40})">'
                                           r'<area shape="rect" coords="64.0,120.0,192.0,160.0" href="#target"></map>'
                                           r'<img .*? src=".*?.png" usemap="#\1" .*?/></div>'))
 
@@ -218,7 +400,7 @@ class TestSphinxcontribActdiagHTML(unittest.TestCase):
         """
         app.builder.build_all()
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
-        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_\d+)">'
+        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_[0-9a-f]{40})">'
                                           r'<area shape="rect" coords="64.0,120.0,192.0,160.0" href="#hello-world">'
                                           r'</map><img .*? src=".*?.png" usemap="#\1" .*?/></div>'))
 
@@ -235,6 +417,116 @@ class TestSphinxcontribActdiagHTML(unittest.TestCase):
         self.assertRegexpMatches(source, r'<div class="align-default"><img .*? src=".*?.png" .*?/></div>')
         self.assertIn('undefined label: unknown_target', warning.getvalue())
 
+    @with_png_app
+    @patch("sphinx.domains.std.StandardDomain.resolve_xref")
+    def test_resolve_reftarget_once(self, app, status, warning, resolve_xref):
+        """
+        .. actdiag::
+
+           A -> B -> C;
+           A [href = ':ref:`unknown_target`'];
+           B [href = ':ref:`unknown_target`'];
+
+        .. actdiag::
+           :width: 100
+
+           A -> B -> C;
+           A [href = ':ref:`unknown_target`'];
+           B [href = ':ref:`unknown_target`'];
+        """
+        resolve_xref.return_value = None
+        app.builder.build_all()
+        self.assertEqual(1, resolve_xref.call_count)
+        self.assertEqual(1, warning.getvalue().count('undefined label: unknown_target'))
+
+    @with_deferred_app
+    def test_deferred_render_on_png(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           C -> D;
+        """
+        app.build(force_all=True)  # images are rendered on build-finished event
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        images = re.findall(r'<div class="align-default"><img .*? src="(_images/.*?.png)" .*?/></div>', source)
+        self.assertEqual(2, len(images))
+        for image in images:
+            self.assertTrue((app.outdir / image).exists())
+
+    @with_cached_app
+    def test_image_cache_on_png(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        app.build(force_all=True)
+        self.assertIn('actdiag cache: 0 hits, 1 misses', status.getvalue())
+        cached = os.listdir(app.config.actdiag_cache_dir)
+        self.assertEqual(1, len(cached))
+
+        # rebuild without images; they are fetched from the cache
+        os.remove(app.outdir / '_images' / cached[0])
+        app.build(force_all=True)
+        self.assertIn('actdiag cache: 1 hits, 0 misses', status.getvalue())
+        self.assertTrue((app.outdir / '_images' / cached[0]).exists())
+
+    @with_png_app
+    def test_dedup_ratio(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           A -> C;
+        """
+        app.build(force_all=True)
+        self.assertEqual(2, len(os.listdir(app.outdir / '_images')))
+        self.assertIn('actdiag: 3 diagrams, 2 unique (dedup ratio: 33.3%)', status.getvalue())
+
+    @with_png_app
+    def test_remove_orphaned_images(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        app.build(force_all=True)
+        images = os.listdir(app.outdir / '_images')
+        self.assertEqual(1, len(images))
+        self.assertEqual({'index': 1}, list(app.env.actdiag_manifest.values())[0]['docnames'])
+
+        orphan = app.outdir / '_images' / ('actdiag-%s.png' % ('0' * 40))
+        orphan.write_text('')
+        app.build(force_all=True)
+        self.assertEqual(images, os.listdir(app.outdir / '_images'))
+
+    @with_png_app
+    def test_rerender_images_on_font_changed(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        app.build(force_all=True)
+        images = os.listdir(app.outdir / '_images')
+        self.assertEqual(1, len(images))
+
+        app.env.actdiag_font_stamps = {'/path/to/font.ttf': 0}
+        outdated = app.emit('env-get-outdated', app.env, set(), set(), set())
+        self.assertIn(['index'], outdated)
+        self.assertEqual([], os.listdir(app.outdir / '_images'))
+
     @with_svg_app
     def test_build_svg_image(self, app, status, warning):
         """
@@ -246,6 +538,533 @@ class TestSphinxcontribActdiagHTML(unittest.TestCase):
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'<div class="align-default"><svg .*?>')
 
+    @with_svg_cached_app
+    def test_svg_cache(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        app.build(force_all=True)
+        self.assertTrue((app.doctreedir / 'actdiag_svg.pickle').exists())
+
+        # rebuild without drawing
+        with patch("actdiag.utils.rst.nodes.actdiag.processor.drawer.DiagramDraw") as DiagramDraw:
+            DiagramDraw.side_effect = RuntimeError("UNKNOWN ERROR!")
+            app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'<div class="align-default"><svg .*?>')
+        self.assertNotIn('UNKNOWN ERROR!', warning.getvalue())
+
+        # the markups are cached as strings; and those of removed diagrams are dropped
+        with open(app.doctreedir / 'actdiag_svg.pickle', 'rb') as f:
+            cache = pickle.load(f)
+        keys = list(cache)
+        self.assertEqual(1, len(keys))
+        self.assertIsInstance(cache[keys[0]], str)
+
+        with open(os.path.join(app.srcdir, 'index.rst'), 'w') as f:
+            f.write('.. actdiag::\n\n   C -> D;\n')
+        app.build()
+        with open(app.doctreedir / 'actdiag_svg.pickle', 'rb') as f:
+            cached = list(pickle.load(f))
+        self.assertEqual(1, len(cached))
+        self.assertNotEqual(keys, cached)
+
+    @with_svg_minified_app
+    def test_minify_svg(self, app, status, warning):
+        """
+        .. actdiag::
+           :width: 100
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default">'
+                                          r'<svg height="109.4" viewBox="0 0 256 280" width="100" '))
+        self.assertRegexpMatches(source, r'<rect fill="#fff" height="40" stroke="#000" width="128" x="64" y="120" />'
+                                         r'<text fill="#000" font-family="sans-serif" font-size="11" '
+                                         r'text-anchor="middle" textLength="6" x="128" y="146">A</text>')
+        self.assertNotIn('inkspace', source)
+
+    @with_svg_external_app
+    def test_external_svg_settings(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        def build():
+            app.build(force_all=True)
+            source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+            relpath = re.search(r'<img height="280" src="(_images/actdiag-[0-9a-f]{40}.svg)"', source).group(1)
+            return (app.outdir / relpath).read_text(encoding='utf-8')
+
+        image = build()
+        app.config.actdiag_svg_minify = True
+        minified = build()
+        self.assertLess(len(minified), len(image))
+        self.assertNotIn('\n  ', minified)
+
+        app.config.actdiag_svg_precision = 0
+        self.assertNotEqual(minified, build())
+        self.assertEqual(1, len(os.listdir(app.outdir / '_images')))  # old files are collected
+
+    @with_svg_external_app
+    def test_external_svg(self, app, status, warning):
+        """
+        .. _target:
+
+        heading2
+        ---------
+
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+           :alt: diagram having links
+
+           A -> B;
+           A [href = ':ref:`target`'];
+        """
+        app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default"><img height="280" '
+                                          r'src="_images/actdiag-[0-9a-f]{40}.svg" width="256" /></div>'))
+        self.assertRegexpMatches(source, (r'<div class="align-default"><object data="_images/actdiag-[0-9a-f]{40}.svg" '
+                                          r'height="280" type="image/svg\+xml" width="256">'
+                                          r'diagram having links</object></div>'))
+        self.assertNotIn('<svg', source)
+
+        filename = re.search(r'<object data="(.*?)"', source).group(1)
+        image = (app.outdir / filename).read_text(encoding='utf-8')
+        self.assertIn('<a target="_top" xlink:href="../index.html#target">', image)
+        self.assertEqual(2, len(os.listdir(app.outdir / '_images')))
+
+        # the drawers are not created for rendered images
+        with patch.object(sphinxcontrib.actdiag.actdiag_node, 'to_drawer') as to_drawer:
+            app.build(force_all=True)
+            self.assertEqual(0, to_drawer.call_count)
+
+        # and they are released after rendered
+        for filename in os.listdir(app.outdir / '_images'):
+            os.remove(app.outdir / '_images' / filename)
+        app.actdiag_svg_files.clear()
+        with patch.object(sphinxcontrib.actdiag, 'release_image',
+                          wraps=sphinxcontrib.actdiag.release_image) as release_image:
+            app.build(force_all=True)
+            self.assertEqual(2, release_image.call_count)
+        self.assertEqual(2, len(os.listdir(app.outdir / '_images')))
+
+    @with_optimized_app
+    def test_optimize_png(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        matched = re.search(r'<picture><source srcset="(_images/actdiag-[0-9a-f]{40}).webp" type="image/webp" />'
+                            r'<img height="280" src="(_images/actdiag-[0-9a-f]{40}).png" width="256" /></picture>',
+                            source)
+        self.assertIsNotNone(matched)
+        self.assertEqual(matched.group(1), matched.group(2))
+
+        filename = app.outdir / matched.group(2) + '.png'
+        with Image.open(filename) as image:
+            self.assertEqual('P', image.mode)
+            self.assertEqual('optimize,quantize', image.info['actdiag-postprocess'])
+        with Image.open(app.outdir / matched.group(1) + '.webp') as image:
+            self.assertEqual('WEBP', image.format)
+
+        # processed images are not rewritten
+        mtime = os.stat(filename).st_mtime_ns
+        app.build(force_all=True)
+        self.assertEqual(mtime, os.stat(filename).st_mtime_ns)
+
+        # lossless images are rendered again after quantization is turned off
+        app.config.actdiag_png_quantize = False
+        app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        relpath = re.search(r'<img height="280" src="(_images/actdiag-[0-9a-f]{40}.png)"', source).group(1)
+        self.assertNotEqual(filename, app.outdir / relpath)
+        with Image.open(app.outdir / relpath) as image:
+            self.assertNotEqual('P', image.mode)
+            self.assertEqual('optimize', image.info['actdiag-postprocess'])
+
+    @with_hidpi_app
+    def test_png_scales(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+           A [href = 'http://example.com/'];
+        """
+        # the HiDPI drawer is set up by the constructor of actdiag
+        DiagramDraw = actdiag.drawer.DiagramDraw
+        with patch.object(DiagramDraw, '__init__', autospec=True, side_effect=DiagramDraw.__init__) as init:
+            app.build(force_all=True)
+        self.assertEqual(2, init.call_count)  # 1x and 2x
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'<area shape="rect" coords="64.0,120.0,192.0,160.0" '
+                                         r'href="http://example.com/">')
+        matched = re.search(r'<img height="280" src="(_images/actdiag-[0-9a-f]{40}).png" '
+                            r'srcset="(_images/actdiag-[0-9a-f]{40}).png 1x, '
+                            r'(_images/actdiag-[0-9a-f]{40})&#64;2x.png 2x" '
+                            r'usemap="#map_[0-9a-f]{40}" width="256" />', source)
+        self.assertIsNotNone(matched)
+        self.assertEqual(1, len(set(matched.groups())))
+
+        with Image.open(app.outdir / matched.group(1) + '.png') as image:
+            self.assertEqual((256, 280), image.size)
+        with Image.open(app.outdir / matched.group(1) + '@2x.png') as image:
+            self.assertEqual((512, 560), image.size)
+
+    @with_canvas_limit_app
+    def test_max_canvas_pixels(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           A -> B -> C -> D -> E -> F -> G -> H -> I;
+        """
+        app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        images = re.findall(r'<img height="280" src="(_images/actdiag-[0-9a-f]{40}).png"', source)
+        self.assertEqual(1, len(images))
+        self.assertRegexpMatches(warning.getvalue(), r'diagram is too large: 256x840 pixels exceeds '
+                                                     r'actdiag_max_canvas_pixels \(200000\)')
+
+        # antialiasing is dropped at 1x, and 2x image is drawn at 1x
+        with Image.open(app.outdir / images[0] + '.png') as image:
+            self.assertEqual((256, 280), image.size)
+        with Image.open(app.outdir / images[0] + '@2x.png') as image:
+            self.assertEqual((256, 280), image.size)
+
+        # the images are rendered in full quality after the limit is removed
+        app.config.actdiag_max_canvas_pixels = None
+        app.actdiag_renderer = sphinxcontrib.actdiag.DiagramRenderer.from_config(app.config)
+        app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        relpaths = re.findall(r'<img height="280" src="(_images/actdiag-[0-9a-f]{40}).png"', source)
+        self.assertEqual(1, len(relpaths))
+        self.assertNotEqual(images, relpaths)
+        with Image.open(app.outdir / relpaths[0] + '@2x.png') as image:
+            self.assertEqual((512, 560), image.size)
+
+    @with_png_app
+    def test_png_layout_without_drawing(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+           A [href = 'http://example.com/'];
+        """
+        app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+
+        # rendered images are reused; the pages are written from the layout
+        with patch("actdiag.utils.rst.nodes.actdiag.processor.drawer.DiagramDraw") as DiagramDraw:
+            DiagramDraw.side_effect = RuntimeError("UNKNOWN ERROR!")
+            app.build(force_all=True)
+        self.assertFalse(DiagramDraw.called)
+        self.assertEqual(source, (app.outdir / 'index.html').read_text(encoding='utf-8'))
+        self.assertNotIn('UNKNOWN ERROR!', warning.getvalue())
+
+    @with_png_app
+    def test_render_from_threads(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        app.build(force_all=True)
+
+        def render(code):
+            node = sphinxcontrib.actdiag.actdiag_node(code=code, options={})
+            with sphinxcontrib.actdiag.blockdiag_context:
+                image = node.to_drawer('SVG', app.builder)
+                image.draw()
+                out = io.StringIO()
+                sphinxcontrib.actdiag.write_svg(image, image.pagesize(), out)
+            return out.getvalue()
+
+        codes = ['thread%d_A -> thread%d_B; lane { thread%d_A; }' % (i, i, i) for i in range(8)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(render, codes * 4))
+
+        sphinxcontrib.actdiag.diagram_cache.clear()
+        expected = [render(code) for code in codes]
+        self.assertEqual(expected * 4, results)
+        self.assertEqual(0, sphinxcontrib.actdiag.blockdiag_context.users)
+
+    @with_render_server_app
+    def test_render_server(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+           A [href = 'http://example.com/'];
+        """
+        # the server is not running; rendered in-process
+        self.assertIsNone(app.actdiag_render_client)
+        app.build(force_all=True)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+
+        path = app.config.actdiag_render_server
+        server = sphinxcontrib.actdiag.RenderServer(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            app.actdiag_render_client = sphinxcontrib.actdiag.connect_render_server(path)
+            self.assertTrue(app.actdiag_render_client)
+
+            (app.outdir / '_images').rmtree(ignore_errors=True)
+            app.build(force_all=True)
+            self.assertEqual(source, (app.outdir / 'index.html').read_text(encoding='utf-8'))
+            self.assertEqual(os.listdir(app.outdir / '_images'), list(server.images))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # fall back to in-process rendering if the server has gone away
+        (app.outdir / '_images').rmtree(ignore_errors=True)
+        app.build(force_all=True)
+        self.assertFalse(app.actdiag_render_client)
+        self.assertEqual(source, (app.outdir / 'index.html').read_text(encoding='utf-8'))
+        self.assertEqual(1, len(os.listdir(app.outdir / '_images')))
+
+    @with_render_ahead_app
+    def test_render_ahead(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+           A [href = 'http://example.com/'];
+
+        .. actdiag::
+
+           A -> B -> C;
+        """
+        threads = []
+        render_image = sphinxcontrib.actdiag.render_image
+
+        def record(job):
+            threads.append(threading.current_thread().name)
+            return render_image(job)
+
+        with patch.object(sphinxcontrib.actdiag, 'render_image', side_effect=record):
+            app.build(force_all=True)
+
+        # rendered in background threads on reading; the writer finds them
+        self.assertEqual(2, len(threads))
+        self.assertTrue(all(name.startswith('actdiag') for name in threads))
+        self.assertEqual({}, app.actdiag_render_ahead_futures)
+        self.assertIsNone(app.actdiag_render_ahead)  # the threads are shut down
+        self.assertEqual(4, len(os.listdir(app.outdir / '_images')))
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'<area shape="rect" coords="64.0,120.0,192.0,160.0" '
+                                         r'href="http://example.com/">')
+        for relpath in re.findall(r'src="(_images/actdiag-[0-9a-f]{40}.png)"', source):
+            with Image.open(app.outdir / relpath) as image:
+                self.assertEqual(256, image.size[0])
+
+    @with_render_ahead_app
+    def test_render_ahead_errors(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        with patch.object(sphinxcontrib.actdiag, 'render_image', side_effect=RuntimeError("UNKNOWN ERROR!")):
+            app.build(force_all=True)
+
+        # the errors are reported on build-finished; the writer renders the image instead
+        self.assertRegexpMatches(warning.getvalue(), r'could not render actdiag-[0-9a-f]{40}.png ahead: UNKNOWN ERROR!')
+        self.assertIsNone(app.actdiag_render_ahead)
+        self.assertEqual(2, len(os.listdir(app.outdir / '_images')))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', parallel=4, copy_srcdir_to_tmpdir=True,
+              confoverrides={'actdiag_cache_dir': tempfile.mkdtemp()})
+    def test_image_cache_on_parallel_build(self, app, status, warning):
+        toctree = ''
+        for i in range(8):
+            with open(os.path.join(app.srcdir, 'doc%d.rst' % i), 'w') as f:
+                f.write('doc%d\n====\n\n.. actdiag::\n\n   A -> B%d;\n' % (i, i))
+            toctree += '   doc%d\n' % i
+        with open(os.path.join(app.srcdir, 'index.rst'), 'w') as f:
+            f.write('index\n=====\n\n.. toctree::\n\n' + toctree)
+
+        app.build(force_all=True)
+        self.assertIn('actdiag cache: 0 hits, 8 misses', status.getvalue())
+
+        # the hits in the writer processes are counted
+        (app.outdir / '_images').rmtree()
+        app.build(force_all=True)
+        self.assertIn('actdiag cache: 8 hits, 0 misses', status.getvalue())
+        self.assertEqual(8, len(os.listdir(app.outdir / '_images')))
+
+        # images are locked by a fixed set of lock files
+        locks = os.listdir(os.path.join(app.doctreedir, 'actdiag_locks'))
+        self.assertTrue(all(re.match(r'^[0-9a-f]{2}\.lock$', name) for name in locks))
+
+    @with_png_app
+    def test_read_while_drawing(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           A -> B -> C;
+        """
+        from blockdiag.utils.bootstrap import Application
+
+        drawing = threading.Event()
+        finished = threading.Event()
+        cleaned = []
+
+        def draw():
+            node = sphinxcontrib.actdiag.actdiag_node(code='A -> B -> C -> D;', options={})
+            with sphinxcontrib.actdiag.blockdiag_context:
+                drawing.set()
+                while not finished.is_set():
+                    node.to_drawer('PNG', app.builder, filename=None).draw()
+
+        cleanup = Application.cleanup
+
+        def record(application):
+            cleaned.append(drawing.is_set() and not finished.is_set())
+            return cleanup(application)
+
+        with patch.object(Application, 'cleanup', autospec=True, side_effect=record):
+            thread = threading.Thread(target=draw)
+            thread.start()
+            try:
+                drawing.wait()
+                app.build(force_all=True)
+            finally:
+                finished.set()
+                thread.join()
+
+        # the state of blockdiag is not cleared while drawing in the other thread
+        self.assertEqual([False], cleaned)
+        self.assertEqual('', warning.getvalue())
+        self.assertEqual(2, len(os.listdir(app.outdir / '_images')))
+
+    @with_png_app
+    def test_prerender(self, app, status, warning):
+        """
+        .. actdiag::
+           :alt: hello
+
+           A -> B;
+
+        .. actdiag::
+
+           A -> B -> C;
+        """
+        failures = sphinxcontrib.actdiag.prerender(app.srcdir, 'html', app.outdir, workers=0)
+        self.assertEqual(0, failures)
+        images = sorted(os.listdir(app.outdir / '_images'))
+        self.assertEqual(2, len(images))
+        mtimes = [os.stat(app.outdir / '_images' / image).st_mtime_ns for image in images]
+
+        # the builder finds the prerendered images
+        with patch.object(sphinxcontrib.actdiag, 'save_image') as save_image:
+            app.build(force_all=True)
+            self.assertFalse(save_image.called)
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(images, sorted(re.findall(r'src="_images/(actdiag-[0-9a-f]{40}.png)"', source)))
+        self.assertEqual(mtimes, [os.stat(app.outdir / '_images' / image).st_mtime_ns for image in images])
+
+    @with_render_server_app
+    def test_render_server_on_font_changed(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        path = app.config.actdiag_render_server
+        server = sphinxcontrib.actdiag.RenderServer(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            app.actdiag_render_client = sphinxcontrib.actdiag.connect_render_server(path)
+            app.build(force_all=True)
+            self.assertEqual(app.env.actdiag_font_stamps, server.fonts)
+            self.assertEqual(1, len(server.images))
+
+            # the stale images are removed, and the server does not restore them
+            stamps = {'/path/to/font.ttf': 1}
+            save_image = sphinxcontrib.actdiag.save_image
+            with patch.object(sphinxcontrib.actdiag, 'get_font_stamps', return_value=stamps), \
+                    patch.object(sphinxcontrib.actdiag, 'save_image', side_effect=save_image) as saved:
+                app.build()
+                self.assertEqual(1, saved.call_count)
+            self.assertEqual(stamps, server.fonts)
+            self.assertEqual(1, len(os.listdir(app.outdir / '_images')))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    @with_png_app
+    def test_reproducible_output(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+           A [href = 'http://example.com/'];
+           lane { A; }
+           lane { B; }
+        """
+        def build():
+            sphinxcontrib.actdiag.diagram_cache.clear()
+            (app.outdir / '_images').rmtree(ignore_errors=True)
+            app.build(force_all=True)
+
+            images = {}
+            for filename in os.listdir(app.outdir / '_images'):
+                with open(app.outdir / '_images' / filename, 'rb') as f:
+                    images[filename] = f.read()
+            return images, (app.outdir / 'index.html').read_text(encoding='utf-8')
+
+        images, source = build()
+        self.assertEqual((images, source), build())
+        self.assertRegexpMatches(source, r'<map name="map_[0-9a-f]{40}">')
+
+    def test_stable_element_ids(self):
+        from blockdiag.utils import uuid as uuid_generator
+
+        acquired = []
+
+        def acquire():
+            # the swap is guarded by the lock; other threads wait for it
+            if sphinxcontrib.actdiag.blockdiag_lock.acquire(timeout=5):
+                acquired.append(uuid_generator.generate)
+                sphinxcontrib.actdiag.blockdiag_lock.release()
+
+        original = uuid_generator.generate
+        with sphinxcontrib.actdiag.stable_element_ids('seed'):
+            self.assertNotEqual(original, uuid_generator.generate)
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            thread.join(0.2)
+            self.assertEqual([], acquired)
+        thread.join()
+        self.assertEqual([original], acquired)
+        self.assertEqual(original, uuid_generator.generate)
+
     @with_svg_app
     def test_width_option_on_svg(self, app, status, warning):
         """
@@ -353,6 +1172,25 @@ class TestSphinxcontribActdiagHTML(unittest.TestCase):
         app.builder.build_all()
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'<a xlink:href="#target">\n\s*<rect .*?>\n\s*</a>')
+        # the markups depending on the current document are not cached
+        self.assertEqual({}, app.actdiag_svg_cache)
+
+    @with_svg_app
+    def test_svg_cache_size(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           C -> D;
+        """
+        with patch.object(sphinxcontrib.actdiag, 'SVG_CACHE_SIZE', 1):
+            app.builder.build_all()
+        self.assertEqual(1, len(app.actdiag_svg_cache))
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(2, source.count('<svg '))
 
     @with_svg_app
     def test_reftarget_in_href_on_svg2(self, app, status, warning):
@@ -403,3 +1241,27 @@ class TestSphinxcontribActdiagHTML(unittest.TestCase):
         app.builder.build_all()
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'<text[^>]+>A_foo</text>')  # 2nd diagram has a node labeled 'A_foo'.
+
+    @with_profile_app
+    def test_profile(self, app, status, warning):
+        """
+        .. actdiag::
+
+           profile_A -> profile_B;
+
+        .. actdiag::
+
+           profile_A -> profile_B -> profile_C;
+        """
+        app.build(force_all=True)
+        self.assertIn('actdiag profile: 2 diagrams', status.getvalue())
+
+        with open(app.outdir / 'actdiag_profile.json') as f:
+            records = json.load(f)
+        self.assertEqual(['index', 'index'], [r['docname'] for r in records])
+        self.assertEqual({2, 6}, set(r['line'] for r in records))
+        for record in records:
+            self.assertEqual('PNG', record['format'])
+            self.assertEqual(40, len(record['hash']))
+            for phase in ('parse', 'layout', 'draw', 'save'):
+                self.assertGreater(record[phase], 0)
@@ -2,6 +2,7 @@
 
 import os
 import re
+from mock import patch
 from sphinx_testing import with_app
 
 import unittest
@@ -31,6 +32,21 @@ with_oldpdf_app = with_app(srcdir='tests/docs/basic',
                                'actdiag_tex_image_format': 'PDF',
                                'actdiag_fontpath': actdiag_fontpath,
                            })
+with_size_report_app = with_app(srcdir='tests/docs/basic',
+                                buildername='latex',
+                                write_docstring=True,
+                                confoverrides={
+                                    'latex_documents': [('index', 'test.tex', '', 'test', 'manual')],
+                                    'actdiag_render_workers': 2,
+                                    'actdiag_size_report': 1,
+                                })
+with_parallel_app = with_app(srcdir='tests/docs/basic',
+                             buildername='latex',
+                             write_docstring=True,
+                             confoverrides={
+                                 'latex_documents': [('index', 'test.tex', '', 'test', 'manual')],
+                                 'actdiag_render_workers': 2,
+                             })
 
 
 class TestSphinxcontribActdiagLatex(unittest.TestCase):
@@ -57,6 +73,25 @@ class TestSphinxcontribActdiagLatex(unittest.TestCase):
         source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{actdiag-.*?}.pdf}')
 
+    @unittest.skipUnless(os.path.exists(actdiag_fontpath), "TrueType font not found")
+    @with_pdf_app
+    def test_pdf_invariant_mode(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+        """
+        from reportlab import rl_config
+
+        invariant = rl_config.invariant
+        app.builder.build_all()
+        self.assertEqual(invariant, rl_config.invariant)
+
+        # no timestamps are embedded
+        filenames = [f for f in os.listdir(app.outdir) if f.endswith('.pdf')]
+        with open(os.path.join(app.outdir, filenames[0]), 'rb') as f:
+            self.assertIn(b'/CreationDate (D:20000101000000', f.read())
+
     @unittest.skipUnless(os.path.exists(actdiag_fontpath), "TrueType font not found")
     @with_oldpdf_app
     def test_build_pdf_image2(self, app, status, warning):
@@ -194,3 +229,67 @@ class TestSphinxcontribActdiagLatex(unittest.TestCase):
         app.builder.build_all()
         source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{actdiag-.*?}.png}')
+
+    @with_parallel_app
+    def test_render_workers(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           C -> D;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
+        images = re.findall(r'\\sphinxincludegraphics{{(actdiag-.*?)}.png}', source)
+        self.assertEqual(2, len(images))
+        self.assertNotEqual(images[0], images[1])
+        for image in images:
+            self.assertTrue((app.outdir / (image + '.png')).exists())
+        self.assertEqual('', warning.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', buildername='latex', copy_srcdir_to_tmpdir=True,
+              confoverrides={
+                  'latex_documents': [(docname, docname + '.tex', '', 'test', 'manual')
+                                      for docname in ('index', 'foo', 'bar')],
+                  'actdiag_render_workers': 2,
+              })
+    def test_render_pool(self, app, status, warning):
+        for docname in ('index', 'foo', 'bar'):
+            with open(os.path.join(app.srcdir, docname + '.rst'), 'w') as f:
+                f.write('.. actdiag::\n\n   %s1 -> B;\n\n.. actdiag::\n\n   %s2 -> B;\n' % (docname, docname))
+
+        from concurrent.futures import ProcessPoolExecutor
+        with patch('concurrent.futures.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as executor:
+            app.build(force_all=True)
+
+        # the pool is shared between the doctrees, and shut down after the build
+        self.assertEqual(1, executor.call_count)
+        self.assertIsNone(app.actdiag_render_pool)
+        for docname in ('index', 'foo', 'bar'):
+            source = (app.outdir / (docname + '.tex')).read_text(encoding='utf-8')
+            self.assertEqual(2, len(re.findall(r'\\sphinxincludegraphics{{actdiag-.*?}.png}', source)))
+
+    @with_size_report_app
+    def test_size_report(self, app, status, warning):
+        """
+        .. actdiag::
+
+           A -> B;
+
+        .. actdiag::
+
+           C -> D -> E;
+        """
+        app.build(force_all=True)
+        source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
+        images = re.findall(r'\\sphinxincludegraphics{{(actdiag-.*?)}.png}', source)
+        sizes = sorted((os.path.getsize(app.outdir / (image + '.png')), image) for image in images)
+
+        output = status.getvalue()
+        self.assertIn('actdiag images: 2 files, %.1f KB in total; top 1:' % (sum(s for s, _ in sizes) / 1024.0),
+                      output)
+        self.assertIn('%8.1f KB %s.png (index)' % (sizes[-1][0] / 1024.0, sizes[-1][1]), output)
+        self.assertNotIn(sizes[0][1], output)